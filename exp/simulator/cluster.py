@@ -0,0 +1,614 @@
+#!/usr/bin/env python3
+
+import heapq
+import itertools
+import math
+from collections import defaultdict
+
+import numpy as np
+
+"""
+Cluster states: the per-node image/layer caches, with the numeric node
+states kept as cluster-wide columns, and the container deadlines in one
+cluster-wide heap
+
+columns (one entry per node):
+    - used, bytes of layers stored
+    - cap, layer store capacity in bytes
+    - conta, live containers
+    - max_conta, container capacity
+    - real_free, bytes free once all unused layers are evicted
+
+the layers held by the nodes are also kept as a presence matrix, see
+LayerMatrix, for scoring all nodes at once, and as inverted indices:
+    - layer_nodes, {int_layer_id: {int_node_index, ...}}
+    - image_nodes, {int_image_id: {int_node_index, ...}}
+the simulator updates them through add/drop_layer and add/drop_image;
+add/drop_layer also give the node a new layer version, see NodeState
+
+the capacity of the nodes is indexed by CapacityIndex; the simulator calls
+capacity.update(node_index) after changing the columns of a node
+
+snapshot() and restore() reset the cluster between runs; while a snapshot
+is kept, the simulator calls NodeState.save_layer/save_image before
+changing an entry of the caches, see Journal
+"""
+
+
+def _new_entry():
+    # [int_ctr, int_last_used, int_freq_used, bool_pinned]
+    return [0, 0, 0, False]
+
+
+def _discard(postings, key, node_index):
+    nodes = postings[key]
+    nodes.discard(node_index)
+    if not nodes:
+        del postings[key]
+
+
+# the layer versions are drawn from one counter, so that a version names
+# one layer set across the copies and snapshots of the clusters
+_layer_versions = itertools.count(1)
+
+
+class EvictionQueue:
+    """The entries of a node cache, {key: state}, in eviction order.
+
+    Entries are ordered by state[index], descending if reverse, and then by
+    insertion into the cache, i.e., the order of a stable sort of the cache
+    items. Updates push a new heap entry; the outdated ones are invalidated
+    lazily as they are popped, and compacted once they pile up.
+    """
+
+    def __init__(self, cache, index, reverse=False):
+        self.index = index
+        self.sign = -1 if reverse else 1
+        # {key: (sort_key, int_seq)} of the valid heap entries
+        self.keys = {}
+        self.seq = 0
+        for key, state in cache.items():
+            self.keys[key] = (self.sign * state[index], self.seq)
+            self.seq += 1
+        self.heap = [(k, s, key) for key, (k, s) in self.keys.items()]
+        heapq.heapify(self.heap)
+
+    def touch(self, key, state):
+        """Insert the key or update its order after state changed."""
+        sort_key = self.sign * state[self.index]
+        current = self.keys.get(key)
+        if current is not None:
+            if current[0] == sort_key:
+                return
+            seq = current[1]
+        else:
+            seq = self.seq
+            self.seq += 1
+        self.keys[key] = (sort_key, seq)
+        heapq.heappush(self.heap, (sort_key, seq, key))
+        if len(self.heap) > 2 * len(self.keys) + 64:
+            self.heap = [(k, s, key) for key, (k, s) in self.keys.items()]
+            heapq.heapify(self.heap)
+
+    def remove(self, key):
+        self.keys.pop(key, None)
+
+    def pop(self):
+        """The next valid entry, (sort_key, seq, key), or None; the entry
+        stays valid and should be restored if the key is kept."""
+        heap, keys = self.heap, self.keys
+        while heap:
+            entry = heapq.heappop(heap)
+            if keys.get(entry[2]) == entry[:2]:
+                return entry
+        return None
+
+    def restore(self, entries):
+        for entry in entries:
+            heapq.heappush(self.heap, entry)
+
+
+class NodeState:
+    """A view of one node; the numeric states live in the cluster columns."""
+    __slots__ = ("cluster", "index", "images", "layers", "layer_version",
+                 "layer_refs", "layer_queues", "image_queues")
+
+    def __init__(self, cluster, index):
+        self.cluster = cluster
+        self.index = index
+        # {int_image_id: [int_ctr, int_last_used, int_freq_used, bool_pinned]}
+        self.images = defaultdict(_new_entry)
+        # {int_layer_id: [int_ctr, int_last_used, int_freq_used, bool_pinned]}
+        self.layers = defaultdict(_new_entry)
+        # changed whenever a layer is added or dropped; the nodes having the
+        # same version have the same layer set, 0 for no layer
+        self.layer_version = 0
+        # {int_layer_id: int_num_image}, the cached images having the layer
+        self.layer_refs = defaultdict(int)
+        # {int_state_index: EvictionQueue}, built on the first eviction
+        self.layer_queues = {}
+        self.image_queues = {}
+
+    @property
+    def used(self):
+        return self.cluster.used[self.index]
+
+    @used.setter
+    def used(self, value):
+        self.cluster.used[self.index] = value
+
+    @property
+    def cap(self):
+        return self.cluster.cap[self.index]
+
+    @cap.setter
+    def cap(self, value):
+        self.cluster.cap[self.index] = value
+
+    @property
+    def conta(self):
+        return self.cluster.conta[self.index]
+
+    @conta.setter
+    def conta(self, value):
+        self.cluster.conta[self.index] = value
+
+    @property
+    def max_conta(self):
+        return self.cluster.max_conta[self.index]
+
+    @max_conta.setter
+    def max_conta(self, value):
+        self.cluster.max_conta[self.index] = value
+
+    @property
+    def real_free(self):
+        return self.cluster.real_free[self.index]
+
+    @real_free.setter
+    def real_free(self, value):
+        self.cluster.real_free[self.index] = value
+
+    def layer_queue(self, index):
+        queue = self.layer_queues.get(index)
+        if queue is None:
+            queue = self.layer_queues[index] = EvictionQueue(self.layers, index)
+        return queue
+
+    def image_queue(self, index, reverse=False):
+        queue = self.image_queues.get(index)
+        if queue is None:
+            queue = self.image_queues[index] = EvictionQueue(self.images, index, reverse)
+        return queue
+
+    def save_layer(self, layer):
+        journal = self.cluster.journal
+        if journal is not None:
+            journal.save(self, "layers", layer)
+
+    def save_image(self, image):
+        journal = self.cluster.journal
+        if journal is not None:
+            journal.save(self, "images", image)
+
+    def touch_layer(self, layer):
+        for queue in self.layer_queues.values():
+            queue.touch(layer, self.layers[layer])
+
+    def touch_image(self, image):
+        for queue in self.image_queues.values():
+            queue.touch(image, self.images[image])
+
+    def drop_layer(self, layer):
+        journal = self.cluster.journal
+        if journal is not None:
+            journal.save(self, "layers", layer, removed=True)
+        self.layers.pop(layer)
+        self.cluster.drop_layer(self.index, layer)
+        for queue in self.layer_queues.values():
+            queue.remove(layer)
+
+    def add_image(self, image, image_layers):
+        """Account for a new cached image; the caller creates its entry."""
+        self.cluster.add_image(self.index, image)
+        self._save_refs(image_layers)
+        refs = self.layer_refs
+        for layer in image_layers:
+            refs[layer] += 1
+
+    def drop_image(self, image, image_layers):
+        journal = self.cluster.journal
+        if journal is not None:
+            journal.save(self, "images", image, removed=True)
+        self.images.pop(image)
+        self.cluster.drop_image(self.index, image)
+        for queue in self.image_queues.values():
+            queue.remove(image)
+        self._save_refs(image_layers)
+        refs = self.layer_refs
+        for layer in image_layers:
+            refs[layer] -= 1
+            if refs[layer] == 0:
+                del refs[layer]
+
+    def _save_refs(self, layers):
+        journal = self.cluster.journal
+        if journal is not None:
+            for layer in layers:
+                journal.save(self, "layer_refs", layer)
+
+    def copy(self, cluster):
+        """Copy the caches; the eviction queues are rebuilt when needed."""
+        node = NodeState(cluster, self.index)
+        node.images.update((k, v[:]) for k, v in self.images.items())
+        node.layers.update((k, v[:]) for k, v in self.layers.items())
+        node.layer_version = self.layer_version
+        node.layer_refs.update(self.layer_refs)
+        return node
+
+
+class LayerMatrix:
+    """Presence of layers on nodes, one row per layer held by any node.
+
+    Rows are allocated when a layer first lands on a node and recycled once
+    no node holds it, so the matrix only spans the layers in the cluster
+    rather than all layers in the trace.
+    """
+
+    def __init__(self, num_node, num_row=64):
+        self.presence = np.zeros((num_row, num_node), dtype=np.uint8)
+        # {int_layer_id: int_row}
+        self.rows = {}
+        # number of nodes holding the layer of each row
+        self.holders = [0] * num_row
+        self.free_rows = list(range(num_row - 1, -1, -1))
+
+    def add(self, layer, node_index):
+        row = self.rows.get(layer)
+        if row is None:
+            if not self.free_rows:
+                self._grow()
+            row = self.free_rows.pop()
+            self.rows[layer] = row
+        self.presence[row, node_index] = 1
+        self.holders[row] += 1
+
+    def drop(self, layer, node_index):
+        row = self.rows[layer]
+        self.presence[row, node_index] = 0
+        self.holders[row] -= 1
+        if self.holders[row] == 0:
+            del self.rows[layer]
+            self.free_rows.append(row)
+
+    def _grow(self):
+        num_row, num_node = self.presence.shape
+        presence = np.zeros((num_row * 2, num_node), dtype=np.uint8)
+        presence[:num_row] = self.presence
+        self.presence = presence
+        self.holders.extend([0] * num_row)
+        self.free_rows.extend(range(num_row * 2 - 1, num_row - 1, -1))
+
+    def scores(self, weights):
+        """Per-node sums of the weights, {int_layer_id: weight}, of the
+        layers each node holds."""
+        rows, ws = [], []
+        for layer, w in weights.items():
+            row = self.rows.get(layer)
+            if row is not None:
+                rows.append(row)
+                ws.append(w)
+        if not rows:
+            return np.zeros(self.presence.shape[1])
+        return np.asarray(ws, dtype=np.float64) @ self.presence[rows]
+
+    def copy(self):
+        matrix = LayerMatrix.__new__(LayerMatrix)
+        matrix.presence = self.presence.copy()
+        matrix.rows = dict(self.rows)
+        matrix.holders = self.holders[:]
+        matrix.free_rows = self.free_rows[:]
+        return matrix
+
+
+def _bucket(size):
+    # log2 buckets of the free space in bytes
+    return int(size).bit_length() if size > 0 else 0
+
+
+class CapacityIndex:
+    """Incremental counts over the cluster columns.
+
+    Keeps the number of nodes with free layer store, a histogram of the free
+    container slots, and the nodes in log2 buckets of the real free space.
+    is_all_full and the rejection of requests no node can fit are O(1); the
+    feasible nodes are enumerated from the buckets when few can fit. The
+    container loads are kept as a count per load level, with their sum and
+    max, for the O(1) heating ratio.
+    """
+    num_bucket = 64
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.rebuild()
+
+    def rebuild(self):
+        num_node = len(self.cluster.used)
+        self.not_full = 0
+        # {int_free_slots: int_num_node}
+        self.conta_hist = defaultdict(int)
+        self.buckets = [set() for _ in range(self.num_bucket)]
+        self.full_of = [True] * num_node
+        self.conta_free_of = [0] * num_node
+        self.bucket_of = [0] * num_node
+        # [int_num_node] indexed by the container load
+        self.load_count = [num_node]
+        self.load_of = [0] * num_node
+        self.load_sum = 0
+        self.max_load = 0
+        self.conta_hist[0] = num_node
+        self.buckets[0].update(range(num_node))
+        for i in range(num_node):
+            self.update(i)
+
+    def update(self, i):
+        cluster = self.cluster
+        full = not cluster.cap[i] - cluster.used[i] > 0
+        if full != self.full_of[i]:
+            self.not_full += -1 if full else 1
+            self.full_of[i] = full
+
+        conta_free = int(cluster.max_conta[i] - cluster.conta[i])
+        old = self.conta_free_of[i]
+        if conta_free != old:
+            self.conta_hist[old] -= 1
+            if self.conta_hist[old] == 0:
+                del self.conta_hist[old]
+            self.conta_hist[conta_free] += 1
+            self.conta_free_of[i] = conta_free
+
+        load = int(cluster.conta[i])
+        old = self.load_of[i]
+        if load != old:
+            load_count = self.load_count
+            if load >= len(load_count):
+                load_count.extend([0] * (load + 1 - len(load_count)))
+            load_count[old] -= 1
+            load_count[load] += 1
+            self.load_of[i] = load
+            self.load_sum += load - old
+            if load > self.max_load:
+                self.max_load = load
+            else:
+                while self.max_load > 0 and load_count[self.max_load] == 0:
+                    self.max_load -= 1
+
+        bucket = _bucket(cluster.real_free[i])
+        old = self.bucket_of[i]
+        if bucket != old:
+            self.buckets[old].discard(i)
+            self.buckets[bucket].add(i)
+            self.bucket_of[i] = bucket
+
+    def all_full(self):
+        return self.not_full == 0
+
+    def heating_ratio(self):
+        """The max over the mean container load; the mean taken as 1 if 0."""
+        avg_load = self.load_sum / len(self.load_of)
+        if avg_load == 0:
+            avg_load = 1
+        return self.max_load / avg_load
+
+    def num_conta_ok(self, num_conta):
+        return sum(c for f, c in self.conta_hist.items() if f >= num_conta)
+
+    def num_store_candidate(self, size):
+        """Upper bound of the nodes able to free size bytes."""
+        return sum(len(b) for b in self.buckets[_bucket(size):])
+
+    def feasible(self, num_conta, size):
+        """Indices of the nodes fitting num_conta containers and size bytes."""
+        if self.num_conta_ok(num_conta) == 0:
+            return np.empty(0, dtype=np.int64)
+        num_candidate = self.num_store_candidate(size)
+        if num_candidate == 0:
+            return np.empty(0, dtype=np.int64)
+
+        cluster = self.cluster
+        if num_candidate * 8 > len(cluster.used):
+            ok = (cluster.max_conta - cluster.conta >= num_conta) & (cluster.real_free >= size)
+            return np.flatnonzero(ok)
+
+        real_free, conta_free_of = cluster.real_free, self.conta_free_of
+        candidates = []
+        for b in self.buckets[_bucket(size):]:
+            candidates.extend(i for i in b if conta_free_of[i] >= num_conta and real_free[i] >= size)
+        return np.array(candidates, dtype=np.int64)
+
+    def copy(self, cluster):
+        index = CapacityIndex.__new__(CapacityIndex)
+        index.cluster = cluster
+        index.not_full = self.not_full
+        index.conta_hist = defaultdict(int, self.conta_hist)
+        index.buckets = [set(b) for b in self.buckets]
+        index.full_of = self.full_of[:]
+        index.conta_free_of = self.conta_free_of[:]
+        index.bucket_of = self.bucket_of[:]
+        index.load_count = self.load_count[:]
+        index.load_of = self.load_of[:]
+        index.load_sum = self.load_sum
+        index.max_load = self.max_load
+        return index
+
+
+class Journal:
+    """Undo log of a cluster since its snapshot.
+
+    The columns and the deadlines are copied at the snapshot. For the caches,
+    the first value of every entry changed is saved as it gets changed, and
+    so is the key order of a cache before its first removal, as the order
+    breaks the ties in eviction. Restoring is proportional to the entries
+    changed, and the journal is reused for the next run.
+    """
+    columns = ("used", "cap", "conta", "max_conta", "real_free")
+
+    def __init__(self, cluster):
+        self.saved_columns = {c: getattr(cluster, c).copy() for c in self.columns}
+        self.expiries = cluster.expiries[:]
+        self.expiry_seq = cluster.expiry_seq
+        self.clear()
+
+    def clear(self):
+        # {(int_node_index, str_cache): {key: first value, None if absent}}
+        self.values = defaultdict(dict)
+        # {(int_node_index, str_cache): [key, ...]}
+        self.orders = {}
+
+    def save(self, node, cache_name, key, removed=False):
+        values = self.values[(node.index, cache_name)]
+        cache = getattr(node, cache_name)
+        if key not in values:
+            value = cache.get(key)
+            values[key] = value[:] if isinstance(value, list) else value
+        if removed and (node.index, cache_name) not in self.orders:
+            self.orders[(node.index, cache_name)] = list(cache.keys())
+
+    def restore(self, cluster):
+        for c in self.columns:
+            getattr(cluster, c)[:] = self.saved_columns[c]
+        cluster.expiries = self.expiries[:]
+        cluster.expiry_seq = self.expiry_seq
+
+        for (i, cache_name), values in self.values.items():
+            node = cluster[i]
+            cache = getattr(node, cache_name)
+            for key, value in values.items():
+                present = key in cache
+                if value is None:
+                    if present:
+                        del cache[key]
+                        if cache_name == "layers":
+                            cluster.drop_layer(i, key)
+                        elif cache_name == "images":
+                            cluster.drop_image(i, key)
+                    continue
+                if isinstance(value, list):
+                    value = value[:]
+                cache[key] = value
+                if not present:
+                    if cache_name == "layers":
+                        cluster.add_layer(i, key)
+                    elif cache_name == "images":
+                        cluster.add_image(i, key)
+
+            order = self.orders.get((i, cache_name))
+            if order is not None:
+                restored = defaultdict(cache.default_factory,
+                                       ((k, cache[k]) for k in order if k in cache))
+                assert len(restored) == len(cache), \
+                    "--> journal order mismatch on node {}.".format(i)
+                setattr(node, cache_name, restored)
+            if cache_name == "layers":
+                node.layer_queues.clear()
+            elif cache_name == "images":
+                node.image_queues.clear()
+        cluster.capacity.rebuild()
+        self.clear()
+
+
+class Cluster:
+    """The nodes of a cluster; indexable like the list of nodes."""
+
+    def __init__(self, num_node, store_size, cont_cap):
+        # sizes are kept in float64, exact for integer byte counts
+        self.used = np.zeros(num_node)
+        self.cap = np.full(num_node, store_size, dtype=np.float64)
+        self.conta = np.zeros(num_node, dtype=np.int64)
+        self.max_conta = np.full(num_node, cont_cap, dtype=np.int64)
+        self.real_free = np.full(num_node, store_size, dtype=np.float64)
+        self.layer_matrix = LayerMatrix(num_node)
+        self.layer_nodes = defaultdict(set)
+        self.image_nodes = defaultdict(set)
+        self.capacity = CapacityIndex(self)
+        # heap of (ddl, int_seq, int_node_index, [int_image_id, ...]); the
+        # deadlines are in seconds, rounded or not, see add_expiry
+        self.expiries = []
+        self.expiry_seq = 0
+        self.journal = None
+        self.nodes = [NodeState(self, i) for i in range(num_node)]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __getitem__(self, index):
+        return self.nodes[index]
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def conta_free(self):
+        return self.max_conta - self.conta
+
+    def add_expiry(self, ddl, node_index, images):
+        heapq.heappush(self.expiries, (ddl, self.expiry_seq, node_index, images))
+        self.expiry_seq += 1
+
+    def pop_expired(self, tick):
+        """The containers due by tick, {int_node_index: [int_image_id, ...]},
+        in the order of their deadlines and placements."""
+        expired, expiries = defaultdict(list), self.expiries
+        while expiries and expiries[0][0] <= tick:
+            _, _, node_index, images = heapq.heappop(expiries)
+            expired[node_index].extend(images)
+        return expired
+
+    def next_expiry(self):
+        """The first tick at which a container is due, or None."""
+        return math.ceil(self.expiries[0][0]) if self.expiries else None
+
+    def add_layer(self, node_index, layer):
+        self.layer_matrix.add(layer, node_index)
+        self.layer_nodes[layer].add(node_index)
+        self.nodes[node_index].layer_version = next(_layer_versions)
+
+    def drop_layer(self, node_index, layer):
+        self.layer_matrix.drop(layer, node_index)
+        _discard(self.layer_nodes, layer, node_index)
+        self.nodes[node_index].layer_version = next(_layer_versions)
+
+    def add_image(self, node_index, image):
+        self.image_nodes[image].add(node_index)
+
+    def drop_image(self, node_index, image):
+        _discard(self.image_nodes, image, node_index)
+
+    def snapshot(self):
+        """Start journaling the changes; see restore."""
+        self.journal = Journal(self)
+
+    def restore(self):
+        """Reset the cluster to the last snapshot."""
+        assert self.journal is not None, "--> no snapshot to restore."
+        self.journal.restore(self)
+
+    def copy(self):
+        """Copy the columns and the caches; cheaper than a deepcopy as no
+        memo is kept and the entries are flat lists. The copy is not
+        journaled."""
+        cluster = Cluster.__new__(Cluster)
+        cluster.used = self.used.copy()
+        cluster.cap = self.cap.copy()
+        cluster.conta = self.conta.copy()
+        cluster.max_conta = self.max_conta.copy()
+        cluster.real_free = self.real_free.copy()
+        cluster.layer_matrix = self.layer_matrix.copy()
+        cluster.layer_nodes = defaultdict(set, ((k, set(v)) for k, v in self.layer_nodes.items()))
+        cluster.image_nodes = defaultdict(set, ((k, set(v)) for k, v in self.image_nodes.items()))
+        cluster.capacity = self.capacity.copy(cluster)
+        # the image lists are not changed once placed
+        cluster.expiries = self.expiries[:]
+        cluster.expiry_seq = self.expiry_seq
+        cluster.journal = None
+        cluster.nodes = [n.copy(cluster) for n in self.nodes]
+        return cluster
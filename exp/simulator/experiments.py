@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 
 import copy
+import multiprocessing
 import os
 import pprint as pp
+import resource
+import zlib
 from collections import defaultdict
 
+import numpy as np
+
 from . import simulator
 from .utils import gb, banner, cmd
 
@@ -13,6 +18,12 @@ _result_path = _dir_path + "/__plot__/__data__/"
 _raw_result_path = _dir_path + "/__result__/"
 _result_file = _result_path + "{exp_name}.csv"
 
+# the sweep points run in this many worker processes, serially if 0; each
+# worker may allocate up to SWEEP_WORKER_MEM gb, if set, beyond what it
+# inherits from the parent, see _limit_worker_mem
+sweep_jobs = int(os.environ.get("SWEEP_JOBS", 0))
+sweep_worker_mem = float(os.environ.get("SWEEP_WORKER_MEM", 0)) * gb
+
 default_params = {"sim_length": 1000,
                   "uniform": False,
                   "zipf": True,
@@ -100,12 +111,13 @@ def _exp_evict_dep(mode):
                    "store_size": 32 * gb,
                    })
 
+    points = []
     for var in evict_enabled:
         params["evict_dep"] = var
         params["result_dir"] = raw_result_dir.format(var)
-        observer.observe(s.sim(**params), key=str(var),
-                         custom_mix=("mean_provision_lat", "mean_startup_lat"))
+        points.append((str(var), dict(params)))
         params["rerun"] = True
+    _sweep(s, points, observer, custom_mix=("mean_provision_lat", "mean_startup_lat"))
 
     observer.save(omit={}, printout=True, dump_params=True)
     return params
@@ -127,11 +139,13 @@ def _exp_ada(mode):
         return
 
     # experiment routines
+    points = []
     for l in lb_ratios:
         params["lb_ratio"] = l
         params["result_dir"] = raw_result_dir.format(l)
-        observer.observe(s.sim(**params), key=l)
+        points.append((l, dict(params)))
         params["rerun"] = True
+    _sweep(s, points, observer)
     return params
 
 
@@ -155,12 +169,14 @@ def _exp_num_image(mode):
         return
 
     # experiment routines
+    points = []
     for i, r in zip(max_num_image_range, rates):
         params["max_num_image"] = i
         params["req_rate"] = r
         params["result_dir"] = raw_result_dir.format(r)
-        observer.observe(s.sim(**params), key=r)
+        points.append((r, dict(params)))
         params["rerun"] = True
+    _sweep(s, points, observer)
     return params
 
 
@@ -180,11 +196,13 @@ def _exp_req_rate(mode):
         rates = [60, 100, 140, 180, 215, 240]
 
     # experiment routines
+    points = []
     for r in rates:
         params["req_rate"] = r
         params["result_dir"] = raw_result_dir.format(r)
-        observer.observe(s.sim(**params), key=r)
+        points.append((r, dict(params)))
         params["rerun"] = True
+    _sweep(s, points, observer)
     return params
 
 
@@ -225,6 +243,7 @@ def _exp_cluster_size(mode):
 
     # experiment specific setups
     cluster_sizes = [25, 50, 100, 200, 400, 800, 1000]
+    points = []
 
     if mode == "pop":
         provision_overhead = 13
@@ -240,8 +259,64 @@ def _exp_cluster_size(mode):
         # the provision latency is estimated as 25)
         params["req_rate"] = int(var * params["cont_cap"] // (params["cont_length"] / 2 + provision_overhead))
 
-        observer.observe(s.sim(**params), key=var)
+        points.append((var, dict(params)))
         params["rerun"] = True
+    _sweep(s, points, observer)
+
+    observer.save(omit={}, printout=True, dump_params=True)
+    return params
+
+
+def _exp_sampled(mode):
+    """Sampled versus full dep, increasing cluster size and sample_k: the
+    startup latency relative to dep (speedup) against the schedule calls
+    per second (sched_rate). dep does not sample: it runs once per cluster
+    size, and its results are reported with every sample_k."""
+    exp_name = "exp_sampled_" + mode
+    raw_result_dir = _raw_result_path + "run_sampled/" + mode + "/{}/"
+    s = simulator.Simulator()
+    params = copy.deepcopy(default_params)
+    # not simulator.sim arguments
+    params.pop("reuse")
+    params.pop("num_puller")
+    observer = ExpObserver(exp_name, params)
+
+    # experiment specific setups
+    params["sched_rate"] = True
+    # same decisions as the loop, the full dep baseline at its fastest
+    params["score_mode"] = "matrix"
+    # per policy streams, such that a policy runs the same alone
+    params["rng"] = "philox"
+    params["sim_length"] = 200
+    cluster_sizes = [500, 2000, 10000]
+    sample_ks = [4, 16, 64]
+    points = []
+
+    for var in cluster_sizes:
+        params["node_num"] = var
+        # the load of exp_cluster_size, see there
+        params["req_rate"] = int(var * params["cont_cap"] // (params["cont_length"] / 2 + 20))
+        params["policies"] = ["dep"]
+        params["result_dir"] = raw_result_dir.format("{}_dep".format(var))
+        points.append(("{}_dep".format(var), dict(params)))
+        params["policies"] = ["dep-sampled", "kube-sampled"]
+        for k in sample_ks:
+            key = "{}_{}".format(var, k)
+            params["sample_k"] = k
+            params["result_dir"] = raw_result_dir.format(key)
+
+            points.append((key, dict(params)))
+            params["rerun"] = True
+    results = dict(zip([key for key, _ in points], _sweep(s, points, None)))
+
+    # as if dep ran first at every point
+    for var in cluster_sizes:
+        dep = results["{}_dep".format(var)]
+        for k in sample_ks:
+            key = "{}_{}".format(var, k)
+            result = {m: dep[m] + v for m, v in results[key].items() if m != "speedup"}
+            result["speedup"] = [lat / dep["mean_startup_lat"][0] for lat in results[key]["mean_startup_lat"]]
+            observer.observe(result, key=key)
 
     observer.save(omit={}, printout=True, dump_params=True)
     return params
@@ -257,12 +332,14 @@ def _exp_store_size(mode):
 
     # experiment specific setups
     store_sizes = [16, 24, 32, 48, 64]
+    points = []
     for var in store_sizes:
         params["store_size"] = var * gb
         params["result_dir"] = raw_result_dir.format(var)
 
-        observer.observe(s.sim(**params), key=var)
+        points.append((var, dict(params)))
         params["rerun"] = True
+    _sweep(s, points, observer)
 
     observer.save(omit={}, printout=True, dump_params=True)
     return params
@@ -281,6 +358,7 @@ def _exp_pool(uniform):
     configs = [(64, 4), (32, 8), (16, 16), (8, 32), (4, 64)]
     params.update({"uniform": uniform,
                    })
+    points = []
 
     for var in configs:
         params["node_num"] = var[0]
@@ -292,8 +370,9 @@ def _exp_pool(uniform):
         # req_rate * (max_cont_length/2 + 2) ~= node_num * cont_cap;
         # the provision latency is estimated as 15)
 
-        observer.observe(s.sim(**params), key=var[0])
+        points.append((var[0], dict(params)))
         params["rerun"] = True
+    _sweep(s, points, observer)
 
     observer.save(omit={}, printout=True, dump_params=True)
     return params
@@ -312,12 +391,14 @@ def _exp_precached(uniform):
     params.update({"uniform": uniform,
                    })
 
+    points = []
     for var in precached:
         params["precached"] = var
         params["result_dir"] = raw_result_dir.format(var)
 
-        observer.observe(s.sim(**params), key=var)
+        points.append((var, dict(params)))
         params["rerun"] = True
+    _sweep(s, points, observer)
 
     observer.save(omit={}, printout=True, dump_params=True)
     return params
@@ -431,6 +512,84 @@ def _clear(exp=None):
         cmd("rm -rf {}run_{}".format(_raw_result_path, exp))
 
 
+class SweepExecutor:
+    """Runs the points of a parameter sweep in a pool of forked workers.
+
+    Each point runs as given by tasks, so its results do not depend on the
+    worker it lands on, nor on whether the sweep runs in workers at all.
+    The results are returned, and observed, in sweep order. The trace is
+    loaded before the workers fork and inherited by them; max_worker_mem,
+    in bytes, caps what each worker allocates beyond that.
+    """
+
+    def __init__(self, num_worker=None, max_worker_mem=None, base_seed=0):
+        self.num_worker = num_worker
+        self.max_worker_mem = max_worker_mem
+        self.base_seed = base_seed
+
+    # the sim arguments the workload is drawn from
+    workload_params = ("sim_length", "req_rate", "uniform", "zipf", "cont_length", "max_num_image")
+
+    def seed_of(self, params):
+        """The seed of a point, from base_seed and the workload arguments
+        only: the points that draw the same workload share it, and so its
+        cache entry, whatever else they vary."""
+        key = zlib.crc32(repr([params.get(k) for k in self.workload_params]).encode())
+        return int(np.random.SeedSequence([self.base_seed, key]).generate_state(1)[0])
+
+    def tasks(self, points):
+        """The sim arguments of the points, [(key, params)] in sweep order:
+        each from a fresh simulator state, i.e., without rerun, seeded as
+        seed_of gives. The policies run serially, as pool workers cannot
+        fork."""
+        return [dict(params, rerun=False, seed=self.seed_of(params), parallel=False)
+                for _, params in points]
+
+    def run(self, points, observer=None, **observe_args):
+        """points: [(key, params)] in sweep order."""
+        simulator.Simulator()
+        tasks = self.tasks(points)
+
+        ctx = multiprocessing.get_context("fork")
+        with ctx.Pool(self.num_worker, initializer=_limit_worker_mem,
+                      initargs=(self.max_worker_mem,)) as pool:
+            results = pool.map(_sweep_point, tasks, chunksize=1)
+
+        if observer is not None:
+            for (key, _), result in zip(points, results):
+                observer.observe(result, key=key, **observe_args)
+        return results
+
+
+def _limit_worker_mem(max_worker_mem):
+    """Cap the worker's address space to the one it inherits, e.g., the
+    trace and the numpy/BLAS reservations, plus max_worker_mem bytes."""
+    if max_worker_mem:
+        with open("/proc/self/statm") as f:
+            inherited = int(f.read().split()[0]) * resource.getpagesize()
+        limit = inherited + int(max_worker_mem)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _sweep_point(params):
+    return simulator.Simulator().sim(**params)
+
+
+def _sweep(s, points, observer, **observe_args):
+    """Run the sweep points in order; in worker processes if sweep_jobs is
+    set, otherwise one after another on s. Either way each point is seeded
+    and run as SweepExecutor.tasks gives, so the results are the same."""
+    executor = SweepExecutor(sweep_jobs, sweep_worker_mem)
+    if sweep_jobs > 0:
+        return executor.run(points, observer, **observe_args)
+    results = []
+    for (key, _), params in zip(points, executor.tasks(points)):
+        results.append(s.sim(**params))
+        if observer is not None:
+            observer.observe(results[-1], key=key, **observe_args)
+    return results
+
+
 class ExpObserver:
     """Records and saves the simulation results."""
 
@@ -495,6 +654,7 @@ def main():
     depsched_intro()
 
     cmds = {"cluster": lambda: exp_routine("cluster_size"),
+            "sampled": lambda: exp_routine("sampled"),
             "store": lambda: exp_routine("store_size"),
             "pool": lambda: exp_routine("pool"),
             "evict": lambda: exp_routine("evict_dep"),
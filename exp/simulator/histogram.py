@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import math
+
+import numpy as np
+
+"""
+Fixed-memory histograms of non-negative values, e.g., latencies
+
+0 has a bucket of its own and reads back exactly, as latencies are mostly
+whole ms; values in (0, 1) fall in linear buckets of width 1/2^sub_bits, the
+first of which starts at 0 but holds no 0; a larger value
+v in [2^e, 2^(e+1)) falls in one of 2^sub_bits linear buckets of that octave
+(HDR-style log-linear buckets), so values read back from the histogram are
+within 2^-(sub_bits+1) of the true value relatively
+"""
+
+
+class LatencyHistogram:
+    def __init__(self, sub_bits=7, max_exp=64):
+        self.sub_bits = sub_bits
+        self.num_sub = 1 << sub_bits
+        self.max_exp = max_exp
+        self.counts = np.zeros(self.num_sub * (max_exp + 1), dtype=np.int64)
+        self.total = 0
+        self.sum = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def __len__(self):
+        return self.total
+
+    def index(self, value):
+        if value < 1:
+            return 0 if value == 0 else max(int(value * self.num_sub), 1)
+        m, e = math.frexp(value)
+        assert e <= self.max_exp, "--> value out of the histogram range: {}.".format(value)
+        return e * self.num_sub + int((2 * m - 1) * self.num_sub)
+
+    def bucket(self, index):
+        """The [low, high) range of the bucket at index."""
+        num_sub = self.num_sub
+        if index == 0:
+            return 0, 0
+        if index == 1:
+            return 0, 2 / num_sub
+        if index < num_sub:
+            return index / num_sub, (index + 1) / num_sub
+        e, sub = divmod(int(index), num_sub)
+        width = math.ldexp(1, e - 1) / num_sub
+        low = math.ldexp(1, e - 1) + sub * width
+        return low, low + width
+
+    def add(self, value):
+        assert value >= 0, "--> negative latency: {}.".format(value)
+        self.counts[self.index(value)] += 1
+        self.total += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        assert self.sub_bits == other.sub_bits and self.max_exp == other.max_exp, \
+            "--> merging histograms of different layouts."
+        self.counts += other.counts
+        self.total += other.total
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def value(self, index):
+        """The value a bucket reads back as: its middle, within the range
+        of the values added."""
+        low, high = self.bucket(index)
+        return min(max((low + high) / 2, self.min), self.max)
+
+    def value_at_rank(self, rank):
+        """The rank-th smallest value (0-based), as sorted(values)[rank]."""
+        assert 0 <= rank < self.total, "--> rank out of range: {}/{}.".format(rank, self.total)
+        index = int(np.searchsorted(np.cumsum(self.counts), rank, side="right"))
+        return self.value(index)
+
+    def mean(self):
+        return self.sum / self.total if self.total else 0
+
+    def nonzero(self):
+        """(value, count) of the buckets having any value, in value order."""
+        return [(self.value(i), int(self.counts[i])) for i in np.flatnonzero(self.counts)]
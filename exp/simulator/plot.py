@@ -5,6 +5,8 @@ from __future__ import print_function
 import glob
 import os
 
+import numpy as np
+
 from .__plot__.plot_gen import plot_hist_param_sweep
 from .utils import cmd
 
@@ -20,6 +22,8 @@ from .utils import cmd
 
     result/run_lat_cdf/uniform|pop:     
     out_lat_dep_20171223142317.csv     out_lat_percentiles_dep_20171223142317.csv     out_meta_dep_20171223142317.csv ...
+    or, with sim(result_format="npy"), out_lat_dep_20171223142317.npy (and .json) in place of the first;
+    with sim(lat_mode="histogram"), out_lat_hist_dep_20171223142317.csv|npy of value,count rows
 """
 
 _dir_path = os.path.dirname(os.path.realpath(__file__))
@@ -64,20 +68,54 @@ class LatPlotter:
                 row = [counter / 3]
         return rows
 
-    def _parse_cdf(self, data_files):
-        """ parse csv files, sort, append cdf indices, and
-        return plot ready list of rows in tuple """
+    # the rows of a cdf having any histogram among its columns
+    cdf_points = 1000
+
+    def _read_lats(self, data_file):
+        """ the sorted latencies of a csv file (or memory-mapped
+        .npy file path), and their counts if a value,count
+        histogram, else None """
+        if isinstance(data_file, str):
+            data = np.load(data_file, mmap_mode="r")
+            if data.ndim == 2:
+                return data[:, 0], data[:, 1].astype(np.int64)
+            return np.sort(data).tolist(), None
+        lines = data_file.readlines()
+        data_file.close()
+        if lines and "," in lines[0]:
+            # out_lat_hist_*.csv, value,count rows in value order
+            data = np.array([d.rstrip().split(",") for d in lines], dtype=np.float64)
+            return data[:, 0], data[:, 1].astype(np.int64)
+        return sorted([int(d.rstrip()) for d in lines]), None
 
-        columns, num_rows = [], 0
-        for data_file in data_files:
-            data_list = sorted([int(d.rstrip())
-                                for d in data_file.readlines()])
-            data_file.close()
-            columns.append(data_list)
-            num_rows = len(data_list)
-        cdf_indices = [(i + 1) / float(num_rows) for i in range(num_rows)]
-        columns.insert(0, cdf_indices)
-        return zip(*columns)
+    def _parse_cdf(self, data_files):
+        """ parse csv files (or memory-map .npy file paths),
+        sort, append cdf indices, and return plot ready list
+        of rows in tuple; with any value,count histogram among
+        them, every column is read at cdf_points cdf indices
+        from its cumulative counts instead of a row per value """
+
+        columns = [self._read_lats(data_file) for data_file in data_files]
+        if all(counts is None for _, counts in columns):
+            columns = [data_list for data_list, _ in columns]
+            num_rows = len(columns[-1]) if columns else 0
+            cdf_indices = [(i + 1) / float(num_rows) for i in range(num_rows)]
+            columns.insert(0, cdf_indices)
+            return zip(*columns)
+
+        num_rows = self.cdf_points
+        rows = [[(i + 1) / float(num_rows) for i in range(num_rows)]]
+        for values, counts in columns:
+            if len(values) == 0:
+                rows.append([])
+                continue
+            if counts is None:
+                counts = np.ones(len(values), dtype=np.int64)
+            cum = np.cumsum(counts)
+            # the value of the ceil(i * total / num_rows)-th latency
+            ranks = -(-np.arange(1, num_rows + 1) * int(cum[-1]) // num_rows)
+            rows.append(np.asarray(values)[np.searchsorted(cum, ranks)].tolist())
+        return zip(*rows)
 
     def _parse_meta(self, data_files, metrics=set({"rej_ratio"})):
         """ assume one line one data; data files are ordered by policies """
@@ -173,13 +211,22 @@ class LatPlotter:
     def gen_cdf(self):
         out_file = _result_path + "lat_cdf_{}.csv"
         path = _raw_result_path + "run_lat_cdf/{}/out_lat_{}*.csv"
+        npy_path = _raw_result_path + "run_lat_cdf/{}/out_lat_{}_*.npy"
+        npy_hist_path = _raw_result_path + "run_lat_cdf/{}/out_lat_hist_{}_*.npy"
+        hist_path = _raw_result_path + "run_lat_cdf/{}/out_lat_hist_{}_*.csv"
 
         for mode in sample_mode:
             data_files = []
             for policy in ordered_policies:
                 print(path.format(mode, policy))
+                npy_files = glob.glob(npy_path.format(mode, policy)) + \
+                            glob.glob(npy_hist_path.format(mode, policy))
+                if npy_files:
+                    data_files.append(npy_files[0])
+                    continue
                 try:
-                    file_name = glob.glob(path.format(mode, policy))[0]
+                    file_name = (glob.glob(path.format(mode, policy)) +
+                                 glob.glob(hist_path.format(mode, policy)))[0]
                     data_files.append(open(file_name, "r"))
                 except:
                     print("missing {}".format(path.format(mode, policy)))
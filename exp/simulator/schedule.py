@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 import random
 import sys
+import zlib
+from collections import OrderedDict, defaultdict
+
 import numpy as np
 from .utils import mb, gb
 from .utils import timed
@@ -11,6 +14,26 @@ Schedule a request on a given set of nodes
 states:
     - tracer, refer to the lookups in it
     - dep_th, dependency score threshold
+    - score_mode, how dep scores the nodes:
+        loop, score node by node in the visit order
+        matrix, score all nodes at once from the cluster's layer matrix
+        postings, score only the nodes holding the request's layers (dep)
+            or images (kube), from the cluster's inverted indices; the
+            others score 0
+    - rng, where the visit order of the nodes comes from:
+        seeder, reseed the global numpy rng from the seed pool per request
+        philox, a Philox stream per (run, policy, request index, tick): keyed
+            by the run and the policy, with the request index and the tick
+            in the high counter words, as the counter advances from its low
+            word; the global rng is left untouched
+    - tie_break, how the vectorized score modes break ties:
+        permutation, the first best node in the visit order
+        random, a uniformly drawn best node, without drawing the visit order
+    - sample_k, the random feasible nodes the sampled policies score, see
+        sample; independent of the cluster size
+
+the nodes are given as a cluster.Cluster; the feasible nodes come from its
+capacity index, and only those are visited, in the visit order
 """
 
 REJ_CONT_LIMIT = -2
@@ -36,64 +59,115 @@ class Seeder():
 
 
 class Scheduler():
-    def __init__(self, tracer, dep_th=0.1):
+    # the plans carrying dep scores, each two int64 arrays of the cluster size
+    score_cache_size = 1 << 8
+    # the random draws per sampled node, before sample lists the feasible ones
+    sample_draws = 8
+
+    def __init__(self, tracer, dep_th=0.1, score_mode="loop",
+                 rng="seeder", tie_break="permutation", sample_k=16):
+        if score_mode not in ("loop", "matrix", "postings"):
+            raise Exception("--> unknown score mode: {}.".format(score_mode))
+        if rng not in ("seeder", "philox"):
+            raise Exception("--> unknown rng: {}.".format(rng))
+        if tie_break not in ("permutation", "random"):
+            raise Exception("--> unknown tie break: {}.".format(tie_break))
+        if sample_k < 1:
+            raise Exception("--> sample_k must be positive: {}.".format(sample_k))
         self.tr = tracer
         self.dep_th = dep_th
+        self.score_mode = score_mode
+        self.rng = rng
+        self.tie_break = tie_break
+        self.sample_k = sample_k
+        # {image_tuple: RequestPlan}, least recently scored first
+        self.scored_plans = OrderedDict()
         self.seeder = Seeder()
+        self.set_stream(None, "")
         print("--> new scheduler init.")
 
+    def set_stream(self, run, policy):
+        """Key the philox streams of the following requests by the run,
+        e.g., the simulation seed, and the policy."""
+        self.stream_key = [0 if run is None else int(run), zlib.crc32(policy.encode())]
+
+    @property
+    def visit_sequence(self):
+        """The order the nodes are visited in, drawn on first use."""
+        if self._visit_sequence is None:
+            self._visit_sequence = self.random.permutation(self.num_node)
+        return self._visit_sequence
+
+    def pick(self, n):
+        """A uniform draw of range(n) from the request's stream."""
+        if self.rng == "seeder":
+            return int(np.random.randint(n))
+        return int(self.random.integers(n))
+
+    def draw(self, n, k):
+        """k uniform draws of range(n), with replacement."""
+        if self.rng == "seeder":
+            return np.random.randint(n, size=k)
+        return self.random.integers(n, size=k)
+
     # @timed
-    def schedule(self, req, nodes, sched="dep", lb_ratio=None):
+    def schedule(self, req, nodes, sched="dep", lb_ratio=None, req_index=0, tick=0):
         """
         scheduling policies:
             dep: select the highest dependency score
             dep-soft: select if the dependency score higher the a threshold
             kube: select if image is present, otherwise any permissible node
             monkey: select any permissible node
+            dep-sampled, kube-sampled: dep and kube over a sample of the
+                nodes only, see sample
 
         before each schedule call, the nodes/nodes are shuffled
         """
-        self.seeder.set_seed()
-        self.visit_sequence = np.random.permutation(len(nodes))
-        # print(self.visit_sequence)
+        if self.rng == "seeder":
+            self.seeder.set_seed()
+            self.random = np.random
+        else:
+            self.random = np.random.Generator(np.random.Philox(
+                key=self.stream_key, counter=[0, 0, req_index, tick]))
+        self.num_node = len(nodes)
+        self._visit_sequence = None
         # random.shuffle(nodes)
 
-        if sched == "dep":
+        if sched == "dep" and self.score_mode == "matrix":
+            return self.dep_matrix_schedule(req, nodes, lb_ratio=lb_ratio)
+        elif sched == "dep" and self.score_mode == "postings":
+            return self.dep_postings_schedule(req, nodes, lb_ratio=lb_ratio)
+        elif sched == "dep":
             return self.dep_schedule(req, nodes, lb_ratio=lb_ratio)
         elif sched == "dep-soft":
             return self.dep_soft_schedule(req, nodes)
+        elif sched == "kube" and self.score_mode == "postings":
+            return self.kube_postings_schedule(req, nodes, lb_ratio=lb_ratio)
         elif sched == "kube":
             return self.kube_schedule(req, nodes, lb_ratio=lb_ratio)
         elif sched == "monkey":
             return self.monkey_schedule(req, nodes)
+        elif sched == "dep-sampled":
+            return self.dep_sampled_schedule(req, nodes, lb_ratio=lb_ratio)
+        elif sched == "kube-sampled":
+            return self.kube_sampled_schedule(req, nodes, lb_ratio=lb_ratio)
         else:
             print("--> error: unknown scheduling policy specified")
             sys.exit(1)
 
     def dep_schedule(self, req, nodes, lb_ratio=None):
-        max_score, selected = -1, -1
-        images = req[0]
-        for i in self.visit_sequence:
+        max_score = -1
+        plan = self.tr.ix.request_plan(req[0])
+        # note that here we assume the scheduler knows whether the node is able to free enough space
+        visit, selected = self.visit(nodes, len(plan.images), plan.total_size)
+        self.cache_scores(plan)
+        for i in visit:
             node = nodes[i]
-            if self.node_conta_free(node) - len(images) < 0:
-                # if self.node_conta_free(node) > 0:
-                    # print(self.node_conta_free(node), len(images))
-                if selected < 0:
-                    selected = REJ_CONT_LIMIT
-                continue
-            total_size = sum([self.tr.image_size(i) for i in images])
-
-            # note that here we assume the scheduler knows whether the node is able to free enough space
-            if total_size > self.real_free_size(node):
-                if selected < 0:
-                    selected = REJ_STORE_LIMIT
-                continue
-
-            score = self.dep_score(images, node)
+            score = self.dep_score(plan, node)
 
             if lb_ratio is not None:
                 score_locality = self.scaled_score_locality(score)
-                score_lb = (node[5] - node[4])/node[5] * 10
+                score_lb = (node.max_conta - node.conta)/node.max_conta * 10
                 score = lb_ratio * score_lb + (1 - lb_ratio) * score_locality
 
             if score > max_score:
@@ -101,6 +175,94 @@ class Scheduler():
                 selected = i
         return selected
 
+    def dep_matrix_schedule(self, req, nodes, lb_ratio=None):
+        """Same as dep_schedule, with the scores of all nodes taken as one
+        product of the layer matrix and the request's layer sizes."""
+        plan = self.tr.ix.request_plan(req[0])
+        cont_ok, store_ok = self.feasible_masks(nodes, len(plan.images), plan.total_size)
+
+        # a layer shared by several images is counted once per image
+        scores = nodes.layer_matrix.scores(plan.weight_map)
+        return self.select(self.blend_lb(scores, nodes, lb_ratio), cont_ok, store_ok)
+
+    def dep_postings_schedule(self, req, nodes, lb_ratio=None):
+        """Same as dep_schedule, accumulating the scores over the nodes that
+        hold any of the request's layers only."""
+        plan = self.tr.ix.request_plan(req[0])
+        cont_ok, store_ok = self.feasible_masks(nodes, len(plan.images), plan.total_size)
+
+        layer_nodes = nodes.layer_nodes
+        partial = defaultdict(int)
+        for l, w in zip(plan.layers, plan.weights):
+            if l not in layer_nodes:
+                continue
+            for n in layer_nodes[l]:
+                partial[n] += w
+        return self.select(self.blend_lb(self.spread(partial, len(nodes)), nodes, lb_ratio),
+                           cont_ok, store_ok)
+
+    def kube_postings_schedule(self, req, nodes, lb_ratio=None):
+        """Same as kube_schedule, accumulating the scores over the nodes that
+        hold any of the request's images only."""
+        images = req[0]
+        ix = self.tr.ix
+        cont_ok, store_ok = self.feasible_masks(nodes, len(images), ix.request_plan(images).total_size)
+
+        image_nodes = nodes.image_nodes
+        partial = defaultdict(int)
+        for i in images:
+            if i not in image_nodes:
+                continue
+            size = ix.image_size(i)
+            for n in image_nodes[i]:
+                partial[n] += size
+        return self.select(self.blend_lb(self.spread(partial, len(nodes)), nodes, lb_ratio),
+                           cont_ok, store_ok)
+
+    @staticmethod
+    def spread(partial, num_node):
+        """Scores of all nodes from {int_node_index: score}; 0 elsewhere."""
+        scores = np.zeros(num_node)
+        if partial:
+            scores[list(partial.keys())] = list(partial.values())
+        return scores
+
+    @staticmethod
+    def blend_lb(scores, nodes, lb_ratio):
+        """Vectorized scaled_score_locality and load balancing blend."""
+        if lb_ratio is None:
+            return scores
+        score_locality = np.where(scores > MAX_SUM_SIZE, 10,
+                                  np.where(scores < MIN_SUM_SIZE, 0,
+                                           scores / (MAX_SUM_SIZE - MIN_SUM_SIZE)))
+        score_lb = (nodes.max_conta - nodes.conta) / nodes.max_conta * 10
+        return lb_ratio * score_lb + (1 - lb_ratio) * score_locality
+
+    def select(self, scores, cont_ok, store_ok):
+        """Vectorized visit: the first node in the visit order having the
+        highest score among the feasible ones; otherwise the rejection of
+        the last node visited, as the loop keeps the latest rejection. With
+        random tie breaks, one of the best nodes, or the node visited last,
+        is drawn directly."""
+        if len(scores) == 0:
+            return -1
+        if self.tie_break == "random":
+            ok = cont_ok & store_ok
+            if ok.any():
+                masked = np.where(ok, scores, -np.inf)
+                best = np.flatnonzero(masked == masked.max())
+                return int(best[self.pick(len(best))])
+            # the node a random visit would end with, uniform as well
+            last = self.pick(len(scores))
+            return REJ_CONT_LIMIT if not cont_ok[last] else REJ_STORE_LIMIT
+
+        order = self.visit_sequence
+        ok = (cont_ok & store_ok)[order]
+        if ok.any():
+            # argmax returns the first of the tied maxima
+            return int(order[np.argmax(np.where(ok, scores[order], -np.inf))])
+        return REJ_CONT_LIMIT if not cont_ok[order[-1]] else REJ_STORE_LIMIT
+
     def scaled_score_locality(self, score):
         if score > MAX_SUM_SIZE:
             score = 10
@@ -112,19 +274,13 @@ class Scheduler():
 
     def dep_soft_schedule(self, req, nodes):
         """TODO: fix the case of multiple image per req."""
-        max_score, selected = -1, -1
-        req_size = self.tr.image_size(req)
-        for i in self.visit_sequence:
-            node = nodes[i]
-            if self.node_conta_free(node) <= 0:
-                if selected < 0:
-                    selected = REJ_CONT_LIMIT
-                continue
-            if self.tr.image_size(req) > self.real_free_size(node):
-                if selected < 0:
-                    selected = REJ_STORE_LIMIT
-                continue
-            score = self.dep_score(req, node)
+        max_score = -1
+        plan = self.tr.ix.request_plan(req[0])
+        req_size = plan.total_size
+        visit, selected = self.visit(nodes, 1, req_size)
+        self.cache_scores(plan)
+        for i in visit:
+            score = self.dep_score(plan, nodes[i])
 
             # the first node encountered has score >= threshold_score
             if score >= self.dep_th * req_size:
@@ -137,29 +293,20 @@ class Scheduler():
         return selected
 
     def kube_schedule(self, req, nodes, lb_ratio=None):
-        max_score, selected = -1, -1
+        max_score = -1
         images = req[0]
+        total_size = self.tr.ix.request_plan(images).total_size
+        visit, selected = self.visit(nodes, len(images), total_size)
 
-        for i in self.visit_sequence:
+        for i in visit:
             node = nodes[i]
-            if self.node_conta_free(node) - len(images) < 0:
-                if selected < 0:
-                    selected = REJ_CONT_LIMIT
-                continue
-
-            total_size = sum([self.tr.image_size(i) for i in images])
-            if total_size > self.real_free_size(node):
-                if selected < 0:
-                    selected = REJ_STORE_LIMIT
-                continue
+            node_images = node.images
 
-            node_images = node[0]
-
-            score = sum([self.tr.image_size(i) for i in images if i in node_images])
+            score = sum([self.tr.ix.image_size(i) for i in images if i in node_images])
 
             if lb_ratio is not None:
                 score_locality = self.scaled_score_locality(score)
-                score_lb = (node[5] - node[4])/node[5] * 10
+                score_lb = (node.max_conta - node.conta)/node.max_conta * 10
                 score = lb_ratio * score_lb + (1 - lb_ratio) * score_locality
 
             if score > max_score:
@@ -168,58 +315,185 @@ class Scheduler():
         return selected
 
     def monkey_schedule(self, req, nodes):
-        selected = -1
         images = req[0]
-        for i in self.visit_sequence:
-            node = nodes[i]
-            if self.node_conta_free(node) - len(images) <= 0:
-                if selected < 0:
-                    selected = REJ_CONT_LIMIT
-                continue
-            total_size = sum([self.tr.image_size(i) for i in images])
-            if total_size > self.real_free_size(node):
-                if selected < 0:
-                    selected = REJ_STORE_LIMIT
+        total_size = self.tr.ix.request_plan(images).total_size
+        # monkey keeps one container slot spare
+        visit, selected = self.visit(nodes, len(images) + 1, total_size)
+        if visit:
+            selected = visit[-1]
+        return selected
+
+    def dep_sampled_schedule(self, req, nodes, lb_ratio=None):
+        """Same as dep_schedule over the sampled nodes; the locality
+        candidates are the nodes holding the request's largest layer."""
+        plan = self.tr.ix.request_plan(req[0])
+        local = []
+        if plan.layers:
+            largest = plan.layers[max(range(len(plan.sizes)), key=plan.sizes.__getitem__)]
+            local.append(nodes.layer_nodes.get(largest, ()))
+        candidates, selected = self.sample(nodes, len(plan.images), plan.total_size, local)
+        self.cache_scores(plan)
+        return self.best(candidates, selected, nodes, lb_ratio,
+                         lambda node: self.dep_score(plan, node))
+
+    def kube_sampled_schedule(self, req, nodes, lb_ratio=None):
+        """Same as kube_schedule over the sampled nodes; the locality
+        candidates are the nodes holding any of the request's images."""
+        images = req[0]
+        ix = self.tr.ix
+        local = [nodes.image_nodes.get(i, ()) for i in images]
+        candidates, selected = self.sample(nodes, len(images), ix.request_plan(images).total_size, local)
+        return self.best(candidates, selected, nodes, lb_ratio,
+                         lambda node: sum([ix.image_size(i) for i in images if i in node.images]))
+
+    def sample(self, nodes, num_conta, size, local=()):
+        """Power-of-k choices: up to sample_k distinct feasible nodes drawn
+        at random, then the feasible nodes of each locality postings in local
+        having at most sample_k nodes, e.g., the holders of a rarely cached
+        image; a widely held one is likely drawn anyway. The nodes are drawn
+        by rejection against the capacity columns; only if sample_draws per
+        node find too few, e.g., on a nearly full cluster, are they drawn
+        from the feasible nodes the capacity index lists. Returns the
+        candidates and what to return if there is none, as visit."""
+        num_node = len(nodes)
+        if num_node == 0:
+            return [], -1
+        k, capacity = self.sample_k, nodes.capacity
+        conta_free_of, real_free = capacity.conta_free_of, nodes.real_free
+        candidates = {}
+        if capacity.num_conta_ok(num_conta) > 0 and capacity.num_store_candidate(size) > 0:
+            if num_node > self.sample_draws * k:
+                for i in self.draw(num_node, self.sample_draws * k).tolist():
+                    if i not in candidates and conta_free_of[i] >= num_conta and real_free[i] >= size:
+                        candidates[i] = None
+                        if len(candidates) == k:
+                            break
+            if len(candidates) < k:
+                feasible = capacity.feasible(num_conta, size)
+                if len(feasible) > k:
+                    feasible = feasible[self.random.choice(len(feasible), k, replace=False)]
+                else:
+                    # all of them, in a random order for the ties
+                    feasible = feasible[self.random.permutation(len(feasible))]
+                candidates = dict.fromkeys(feasible.tolist())
+        if not candidates:
+            # the node a random visit would end with
+            last = self.pick(num_node)
+            return [], REJ_CONT_LIMIT if nodes.max_conta[last] - nodes.conta[last] < num_conta \
+                else REJ_STORE_LIMIT
+
+        for postings in local:
+            if len(postings) > k:
                 continue
-            selected = i
+            for i in postings:
+                if i not in candidates and conta_free_of[i] >= num_conta and real_free[i] >= size:
+                    candidates[i] = None
+        return list(candidates), -1
+
+    def best(self, candidates, selected, nodes, lb_ratio, score_of):
+        """The first candidate with the highest score_of(node), blended with
+        the load as in dep_schedule; selected if there is no candidate."""
+        max_score = -1
+        for i in candidates:
+            node = nodes[i]
+            score = score_of(node)
+
+            if lb_ratio is not None:
+                score_locality = self.scaled_score_locality(score)
+                score_lb = (node.max_conta - node.conta)/node.max_conta * 10
+                score = lb_ratio * score_lb + (1 - lb_ratio) * score_locality
+
+            if score > max_score:
+                max_score = score
+                selected = i
         return selected
 
-    def dep_score(self, images, node):
-        node_layers = node[1]
+    def dep_score(self, plan, node):
+        """The size of the request's layers on the node, a layer counted
+        once per image having it; plan as a trace.RequestPlan. Cached on
+        the plan until the node's layers change, see cache_scores."""
+        versions, i, version = plan.score_versions, node.index, node.layer_version
+        if versions is not None and versions[i] == version:
+            return int(plan.score_values[i])
 
+        node_layers = node.layers
         score = 0
-        for i in images:
-            req_layers = self.tr.layers_(i)
-            for l in req_layers:
-                if l in node_layers:
-                    score += self.tr.layer_size(l)
+        for l, w in zip(plan.layers, plan.weights):
+            if l in node_layers:
+                score += w
+        if versions is not None:
+            versions[i] = version
+            plan.score_values[i] = score
         return score
 
+    def cache_scores(self, plan):
+        """Keep the dep scores of the plan, for the last score_cache_size
+        plans scored; the least recently scored plan drops its scores."""
+        plans = self.scored_plans
+        key = plan.images
+        # the plan may be a new one of the same images, see request_plan
+        if plans.get(key) is plan and len(plan.score_versions) >= self.num_node:
+            plans.move_to_end(key)
+            return
+        stale = plans.pop(key, None)
+        if stale is not None:
+            stale.score_versions = stale.score_values = None
+        plans[key] = plan
+        if len(plans) > self.score_cache_size:
+            _, dropped = plans.popitem(last=False)
+            dropped.score_versions = dropped.score_values = None
+        # -1 as no version, 0 being that of a node without layers
+        plan.score_versions = np.full(self.num_node, -1, dtype=np.int64)
+        plan.score_values = np.zeros(self.num_node, dtype=np.int64)
+
     def required_size(self, req, node, verbose=False):
-        images, layers = node[0], node[1]
+        images, layers = node.images, node.layers
         if req in images:
             return 0
         size = 0
+        ix = self.tr.ix
 
         for i in req:
-            req_layers = self.tr.layers_(i)
+            req_layers = ix.image_layers(i)
             if verbose:
                 print("real image size: ",
-                      sum([self.tr.layer_size(l) for l in req_layers]))
+                      sum([ix.layer_size(l) for l in req_layers]))
             for l in req_layers:
                 if l not in layers:
-                    size += self.tr.layer_size(l)
+                    size += ix.layer_size(l)
         return size
 
+    def visit(self, nodes, num_conta, size):
+        """The feasible nodes in the visit order, and what to return if
+        there is none: the rejection of the last node visited, as the
+        loop kept overwriting it."""
+        order = self.visit_sequence
+        if len(order) == 0:
+            return [], -1
+        last = order[-1]
+        rej = REJ_CONT_LIMIT if nodes.max_conta[last] - nodes.conta[last] < num_conta \
+            else REJ_STORE_LIMIT
+        feasible = nodes.capacity.feasible(num_conta, size)
+        if len(feasible) == 0:
+            return [], rej
+        ok = np.zeros(len(order), dtype=bool)
+        ok[feasible] = True
+        return order[ok[order]].tolist(), rej
+
+    def feasible_masks(self, nodes, num_conta, size):
+        """Per-node flags of whether num_conta containers fit and whether
+        size bytes can be freed."""
+        return nodes.conta_free() >= num_conta, nodes.real_free >= size
+
     def real_free_size(self, node):
         """Given a node, compute how much space are free after eviction."""
-        return node[7]
+        return node.real_free
 
     def node_conta_free(self, node):
-        return node[5] - node[4]
+        return node.max_conta - node.conta
 
     def inc_node_conta(self, node, value=1):
-        node[4] += value
+        node.conta += value
 
 
 def scheduler_test():
@@ -2,19 +2,21 @@
 
 from __future__ import print_function
 
-import copy
+import multiprocessing
 import random
 import time
-import redis, pickle
 from bisect import bisect
 from collections import defaultdict
 
 import numpy as np
 
+from .cluster import Cluster
+from .histogram import LatencyHistogram
 from .schedule import Scheduler
 from .telemetry import Telemetry
 from .trace import Tracer
 from .utils import gb, timed
+from .workload import LazyRequests, ReplayStream, RequestStream, WorkloadCache, generate, rng_state, set_rng_state, to_arrays, to_req_list
 
 """
 Orchestrate the simulation and manage the cluster states
@@ -23,10 +25,20 @@ Assumptions:
     - independent from the scheduling on other resource constraints, e.g., cpu/memory/net
 """
 
+# the policies evicting with evict_policy and delay scheduling; the others
+# evict as kube
+DEP_POLICIES = ("dep", "dep-sampled")
+
 
 class Simulator:
     def __init__(self):
         self.tr = Tracer()
+        self.seed = None
+        self.workload_cache = False
+        self.workload_gen = "loop"
+        self.replay_file = None
+        self.replay_tick = 1.0
+        self.sched_rate = False
 
     def init_cluster(self,
                      num_node=100,
@@ -37,45 +49,34 @@ class Simulator:
                      pinned=False,
                      ):
 
-        # start with each node empty
-        # [[dict{str_image_name:[int_ctr, int_last_used, int_freq_used, bool_pinned]...},
-        #   dict{str_layer_digest:[int_ctr, int_last_used, int_freq_used, pinned]...},
-        #   int_cur_size, int_max_size, int_conta, int_max_conta,
-        #   dict{int_ddl: [str_image_name,...]}, real_free_size]]
-        self.node_list = [[defaultdict(lambda: [0, 0, 0, False]),
-                           defaultdict(lambda: [0, 0, 0, False]),
-                           0, store_size, 0, cont_cap,
-                           defaultdict(list), store_size, list] for _ in range(num_node)]
+        # start with each node empty; see cluster.NodeState for the node states
+        self.cluster = Cluster(num_node, store_size, cont_cap)
 
         if precached:
             print("--> precached mode: warming up the cache..")
             if cached_rank < 0:
                 # randomly warm up the cache
-                for node in self.node_list:
-                    sampled_images = self.tr.get_random_images(count=200)
+                for node in self.cluster:
+                    sampled_images = [self.tr.ix.image_id(i) for i in self.tr.get_random_images(count=200)]
                     for image in sampled_images:
-                        image_size = self.tr.image_size(image)
-                        if node[2] + image_size > node[3] * (1 - self.evict_th):
+                        image_size = self.tr.ix.image_size(image)
+                        if node.used + image_size > node.cap * (1 - self.evict_th):
                             break
-                        self.place_node(0, (image, 0), node, pinned=pinned, image_only=True)
+                        self.place_node(0, ([image], 0), node, pinned=pinned, image_only=True)
             else:
-                images = self.tr.get_top_images(cached_rank)
-                for node in self.node_list:
+                images = [self.tr.ix.image_id(i) for i in self.tr.get_top_images(cached_rank)]
+                for node in self.cluster:
                     for image in images:
-                        self.place_node(0, (image, 0), node, pinned=pinned, image_only=True)
+                        self.place_node(0, ([image], 0), node, pinned=pinned, image_only=True)
 
         print("--> new cluster init.")
 
     @timed
     def init_req_queue(self, sim_length=100, req_rate=40,
                        uniform=False, cont_length=1000, zipf=False,
-                       max_num_image=1, from_cache=False):
-        # [(str_image_name, int_duration)...]
-
-        self.req_list = []
-        self.req_seq = []
+                       max_num_image=1):
+        # [([int_image_id, ...], int_duration)...]
 
-        r = redis.StrictRedis(host='localhost')
         num_req = sim_length * req_rate
         self.duration = num_req // req_rate
         self.tr.set_metric("duration", self.duration)
@@ -83,21 +84,75 @@ class Simulator:
         self.sim_length = sim_length
         self.req_rate = req_rate
 
+        if self.workload_gen == "replay":
+            # the log decides the length and the rate
+            self.req_list = ReplayStream(self.tr, self.replay_file, self.replay_tick)
+            self.req_list.report()
+            self.req_seq = self.req_list.req_seq
+            self.sim_length = self.duration = len(self.req_seq)
+            self.req_rate = len(self.req_list) / max(len(self.req_seq), 1)
+            self.tr.set_metric("duration", self.duration)
+            self.seed_pool = None
+            print("--> request replay init.")
+            return
+
+        if self.workload_gen == "stream":
+            # seeded by the run seed, else by the global rng as the others
+            seed = self.seed if self.seed is not None else int(np.random.randint(2 ** 32))
+            self.req_list = RequestStream(self.tr, sim_length, req_rate, uniform, zipf, cont_length,
+                                          max_num_image, seed)
+            self.req_seq = self.req_list.req_seq
+            self.seed_pool = None
+            print("--> request stream init.")
+            return
+
+        # seeded workloads are cached on disk, see workload.WorkloadCache
+        cache, key = None, None
+        if self.seed is not None and self.workload_cache:
+            cache = WorkloadCache()
+            key = cache.key(dict(sim_length=sim_length, req_rate=req_rate, uniform=uniform, zipf=zipf,
+                                 cont_length=cont_length, max_num_image=max_num_image, seed=self.seed,
+                                 gen=self.workload_gen),
+                            self.tr.trace_digest(), rng_state())
+            arrays = cache.load(key)
+            if arrays is not None:
+                self.req_seq = arrays["req_seq"].tolist()
+                self.req_list = to_req_list(arrays)
+                # not read by the scheduler, see schedule.seed_pool
+                self.seed_pool = None
+                set_rng_state(arrays)
+                print("--> request queue loaded from cache {}.".format(key))
+                return
+
+        if self.workload_gen == "vector":
+            arrays = generate(self.tr, sim_length, req_rate, uniform, zipf, cont_length, max_num_image)
+            self.req_seq = arrays["req_seq"].tolist()
+            self.req_list = to_req_list(arrays)
+            # not read by the scheduler, see schedule.seed_pool
+            self.seed_pool = None
+            if cache is not None:
+                arrays.update(rng_state())
+                cache.store(key, arrays)
+            print("--> request queue init.")
+            return
+
+        self.req_list = []
+        self.req_seq = []
+
         while sum(self.req_seq) < num_req:
             self.req_seq.append(np.random.poisson(req_rate))
         diff = sum(self.req_seq) - num_req
         num_req += diff
 
         # sample a set of images uniformly as requests
-        if uniform and not zipf and not from_cache:
+        if uniform and not zipf:
             image_list = self.tr.image_list_()
             while len(self.req_list) < num_req:
                 num_image_reg = random.randint(1, max_num_image)
                 self.req_list.append([random.sample(image_list, num_image_reg),
                                       int(random.random() * cont_length + 1)])
-            r.set("req_list", pickle.dumps(self.req_list))
         # sample a set of images with weights/popularity as the requests
-        elif not from_cache:
+        else:
             image_pop_list = self.tr.image_pop_list_() \
                 if not zipf else self.tr.image_pop_list_zipf_()
             self._gen_cumweights(image_pop_list)
@@ -106,28 +161,33 @@ class Simulator:
                 images = self.weighted_sample(image_pop_list, num_image_reg)
                 self.req_list.append(
                     [images, int(random.random() * cont_length + 1)])
-            r.set("req_list", pickle.dumps(self.req_list))
-        else:
-            start = time.time()
-            self.req_list = pickle.loads(r.get("req_list"))
-            print("loading {} ".format(time.time() - start))
         # self.tr.analyze_req_list(self.req_list)
 
+        # the simulation refers to images by their interned ids
+        ix = self.tr.ix
+        image_index = {ix.image_name(i): i for i in ix.listed.tolist()}
+        self.req_list = [[[image_index[i] for i in images], duration]
+                         for images, duration in self.req_list]
+
+        # not read by the scheduler, but drawn still as it advances the
+        # random stream, and so the results, of the runs that follow
         self.seed_pool = random.sample(list(range(num_req)) * 4, num_req)
 
+        if cache is not None:
+            arrays = to_arrays(self.req_seq, self.req_list)
+            arrays.update(rng_state())
+            cache.store(key, arrays)
+
         # print("--> debug: requests are: ", self.req_list)
         print("--> request queue init.")
 
-    def is_all_full(self, nodes):
-        for n in nodes:
-            if n[3] - n[2] > 0:
-                return False
-        return True
+    def is_all_full(self, cluster):
+        return cluster.capacity.all_full()
 
     # @timed
-    def calc_latency(self, req, node, num_puller):
+    def calc_latency(self, req, node, num_puller=1):
         # report the pull latency of the image-node pair, in milliseconds
-        node_images, node_layers = node[0], node[1]
+        node_images, node_layers = node.images, node.layers
         req_images = req[0]
         time = 0
 
@@ -141,67 +201,78 @@ class Simulator:
             return time
             # print("debug: missing image: ", req)
 
-        # the true pulling time is given at the layer level
-        for image in req_images:
-            req_layers = self.tr.layers_(image)
-            for l in req_layers:
-                if l not in node_layers:
-                    time += self.tr.layer_dl_time(l)
-                    time += self.tr.layer_reg_time(l)
+        # the true pulling time is given at the layer level; a layer shared
+        # by several images is pulled once
+        plan = self.tr.ix.request_plan(req_images)
+        for l, t in zip(plan.layers, plan.pull_times):
+            if l not in node_layers:
+                time += t
         return time
 
     # @timed
     def place_node(self, sig, req, node, *, pinned=False, image_only=False):
-        node_images, node_layers, containers = node[0], node[1], node[6]
+        node_images, node_layers = node.images, node.layers
         req_images, duration = req[0], req[1]
 
-        req_layers = set()
-        for image in req_images:
-            req_layers.update(self.tr.layers_(image))
+        ix = self.tr.ix
+        cluster = node.cluster
+        plan = ix.request_plan(req_images)
 
-        provision_lat, required_size = 0, 0
-        for digest in req_layers:
+        provision_lat, required_size, taken_size = 0, 0, 0
+        for l, size, pull_time in zip(plan.layers, plan.sizes, plan.pull_times):
             new_layer = False
-            if digest not in node_layers:
-                size = self.tr.layer_size(digest)
-                node[2] += size
-                node[7] -= size
+            if l not in node_layers:
                 required_size += size
-                provision_lat += self.tr.layer_pull_time(digest)
+                provision_lat += pull_time
+                cluster.add_layer(node.index, l)
                 new_layer = True
-            layer = node_layers[digest]
+            node.save_layer(l)
+            layer = node_layers[l]
             layer[0] += 1
             layer[1] = sig
             layer[2] += 1
             layer[3] = pinned
+            node.touch_layer(l)
             if not new_layer and layer[0] == 1 and not layer[3]:
-                node[7] -= self.tr.layer_size(digest)
+                taken_size += size
+        node.used += required_size
+        node.real_free -= required_size + taken_size
 
-        # convert to seconds
-        ddl = round(sig + provision_lat / 1000 + duration)
+        # convert to seconds; containers are released at the first tick
+        # at or after the deadline
+        ddl = sig + provision_lat / 1000 + duration
+        if self.expiry == "round":
+            ddl = round(ddl)
 
         for image in req_images:
+            node.save_image(image)
+            if image not in node_images:
+                node.add_image(image, ix.image_layers(image))
             node_images[image][0] += 1
             node_images[image][1] = sig
             node_images[image][2] += 1
             node_images[image][3] = pinned
-            if not image_only:
-                containers[ddl].append(image)
-                node[4] += 1  # update the live container counts
-        assert node[7] >= 0
-        return required_size
+            node.touch_image(image)
+        if not image_only:
+            cluster.add_expiry(ddl, node.index, list(req_images))
+            node.conta += len(req_images)  # update the live container counts
+        cluster.capacity.update(node.index)
+        assert node.real_free >= 0
+        return required_size, ddl
 
     # @timed
     def evict_node(self, node, *,
                    evict_policy,
                    evict_th=0.1,
                    ):
-        images, layers, containers = node[0], node[1], node[6]
-        used, cap, freed = node[2], node[3], 0
+        images, layers = node.images, node.layers
+        used, cap, freed = node.used, node.cap, 0
+        ix = self.tr.ix
+        cluster = node.cluster
         available = cap - used
 
         # gc_target defines the target free space the node should have
-        gc_target = (1 - evict_th) * node[3]
+        gc_target = (1 - evict_th) * cap
         # layer based eviction
         if self.evict_dep and evict_policy in {"dep-lru", "dep-lfu"}:
             if evict_policy == "dep-lru":
@@ -211,106 +282,123 @@ class Simulator:
             else:
                 raise Exception("--> unknown layer-based eviction: {}.".format(evict_policy))
 
-            layer_gc_list = sorted(layers.items(), key=lambda x: x[1][sort_index])
-
-            for digest, state in layer_gc_list:
-                if node[2] < gc_target:
-                    break
-
-                if state[0] > 0 or state[3]:
-                    continue
+            # layers in use are skipped and put back to the queue after
+            if used >= gc_target:
+                queue, skipped = node.layer_queue(sort_index), []
+                while used >= gc_target:
+                    entry = queue.pop()
+                    if entry is None:
+                        break
+                    l = entry[2]
+                    state = layers[l]
+                    if state[0] > 0 or state[3]:
+                        skipped.append(entry)
+                        continue
 
-                layers.pop(digest)
-                layer_size = self.tr.layer_size(digest)
-                freed += layer_size
-                node[2] -= layer_size
-
-                # make sure images having layers evicted are also evicted
-                layer_images = self.tr.layer_image(digest)
-                for image in layer_images:
-                    if image in images:
-                        images.pop(image)
-                self.ty.report_gc(layer_size)
-        else:
-            # image-based eviction; default: LRU-image; sorted from
-            # the most recent to the most early to use the list as a
-            # stack more efficiently
-            image_gc_list = sorted(images.items(), key=lambda x: x[1][1], reverse=True)
-            for name, state in image_gc_list:
-                if node[2] < gc_target:
+                    node.drop_layer(l)
+                    layer_size = ix.layer_size(l)
+                    freed += layer_size
+                    used -= layer_size
+
+                    # make sure images having layers evicted are also evicted
+                    layer_images = ix.layer_images(l).tolist()
+                    for image in layer_images:
+                        if image in images:
+                            node.drop_image(image, ix.image_layers(image))
+                    self.ty.report_gc(layer_size)
+                queue.restore(skipped)
+        elif used >= gc_target:
+            # image-based eviction; default: LRU-image; ordered from
+            # the most recent to the most early, as the queue pops
+            queue, skipped = node.image_queue(1, reverse=True), []
+            while used >= gc_target:
+                entry = queue.pop()
+                if entry is None:
                     break
+                image = entry[2]
+                state = images[image]
                 # handling image removal
                 # state: [int_ctr, int_last_used, int_freq_used, bool_pinned].
                 if state[0] > 0 or state[3]:
+                    skipped.append(entry)
                     continue
-                images.pop(name)
+                image_layers = ix.image_layers(image)
+                node.drop_image(image, image_layers)
                 # handling layer removal
-                image_layers = self.tr.layers_(name)
-                for digest in image_layers:
-                    if digest not in layers or layers[digest][0] > 0:
+                for l in image_layers:
+                    if l not in layers or layers[l][0] > 0:
                         continue
-                    shared = False
-                    layer_images = self.tr.layer_image(digest)
-                    # make sure images having layers evicted will also be
-                    # removed from record; if the layer is shared by other
-                    # images, do not remove the layer until the last image
-                    # using it is removed. This would guarantee correctness.
-                    # TODO: add a share counter for the layer state
-                    for name in layer_images:
-                        if name in images:
-                            shared = True
-                            break
+                    # if the layer is shared by other cached images, do not
+                    # remove the layer until the last image using it is
+                    # removed; node.layer_refs counts them
+                    shared = l in node.layer_refs
                     if not shared:
-                        assert digest in layers
-                        layers.pop(digest)
-                        layer_size = self.tr.layer_size(digest)
+                        assert l in layers
+                        node.drop_layer(l)
+                        layer_size = ix.layer_size(l)
                         freed += layer_size
-                        node[2] -= layer_size
+                        used -= layer_size
                         self.ty.report_gc(layer_size)
+            queue.restore(skipped)
+        if freed:
+            node.used = used
+            cluster.capacity.update(node.index)
         available += freed
-        assert node[2] >= 0, "--> used space should be greater than 0, {} given.".format(node[2])
-        assert node[7] >= 0
-        assert node[2] <= node[3], "--> used exceeds capacity: {}/{}".format(node[2], node[3])
-        assert 0 <= node[4] <= node[5], \
-            "--> erroneous container count: {}/{}".format(node[4], node[5])
+        assert used >= 0, "--> used space should be greater than 0, {} given.".format(used)
+        assert node.real_free >= 0
+        assert used <= cap, "--> used exceeds capacity: {}/{}".format(used, cap)
+        assert 0 <= node.conta <= node.max_conta, \
+            "--> erroneous container count: {}/{}".format(node.conta, node.max_conta)
         # the assertion below can be time consuming
-        # assert sum([self.tr.layer_size(l) for l in layers]) == node[2], \
-        #     "--> total layer size mismatch. {}/{}".format(sum([self.tr.layer_size(l) for l in layers]), node[2])
-        # assert available >= gc_target or node[5] == node[4], \
-        #     "--> unable to free enough space: {}/{}/{}/{}.".format(available, freed, gc_target, node[4])
+        # assert sum([ix.layer_size(l) for l in layers]) == used, \
+        #     "--> total layer size mismatch. {}/{}".format(sum([ix.layer_size(l) for l in layers]), used)
+        # assert available >= gc_target or node.max_conta == node.conta, \
+        #     "--> unable to free enough space: {}/{}/{}/{}.".format(available, freed, gc_target, node.conta)
         return available
 
     def real_free_space(self, node):
-        used = sum([self.tr.layer_size(digest) for digest, layer in node[1].items() if layer[0] > 0])
-        return node[3] - used
+        used = sum([self.tr.ix.layer_size(l) for l, layer in node.layers.items() if layer[0] > 0])
+        return node.cap - used
 
     # @timed
     def update_nodes(self, sig, nodes, *,
+                     expired=None,
                      evict_interval=1,
                      evict_policy="kube",
                      evict_th=0.1):
+        """Release the containers due by sig and evict the nodes. The
+        containers expired, if not given, are taken from the cluster; the
+        nodes should then include all nodes having them."""
+        ix = self.tr.ix
+        if expired is None:
+            expired = self.cluster.pop_expired(sig)
         for node in nodes:
-            images, layers, containers = node[0], node[1], node[6]
+            images, layers = node.images, node.layers
 
             # remove containers, update counters and obtain a list of image
             # to garbage collect
-            if sig in containers:
-                for image_name in containers[sig]:
+            if node.index in expired:
+                released = 0
+                for image in expired[node.index]:
                     # assertion to avoid default dict generate any images
-                    assert image_name in images
-                    node[4] -= 1  # container counts
+                    assert image in images
 
-                    if images[image_name][0] > 0:
-                        images[image_name][0] -= 1
+                    if images[image][0] > 0:
+                        node.save_image(image)
+                        images[image][0] -= 1
 
-                    for digest in self.tr.layers_(image_name):
-                        assert digest in layers
-                        layer = layers[digest]
+                    for l in ix.image_layers(image):
+                        assert l in layers
+                        layer = layers[l]
                         if layer[0] > 0:
+                            node.save_layer(l)
                             layer[0] -= 1
                             if layer[0] == 0 and not layer[3]:
-                                node[7] += self.tr.layer_size(digest)
-            assert node[7] <= node[3], str((node[7], node[3]))
+                                released += ix.layer_size(l)
+                node.conta -= len(expired[node.index])  # container counts
+                node.real_free += released
+                node.cluster.capacity.update(node.index)
+                assert node.real_free <= node.cap, str((node.real_free, node.cap))
             # skip if eviction not enabled or not at the right moment
             if self.evict and (sig % evict_interval) == 0:
                 self.evict_node(node,
@@ -318,12 +406,242 @@ class Simulator:
                                 evict_th=evict_th)
 
     def node_heating_ratio(self):
-        node_load = [n[4] for n in self.node_list]
-        avg_load = np.average(node_load)
-        if avg_load == 0:
-            avg_load = 1
-        max_load = np.max(node_load)
-        return max_load/avg_load
+        return self.cluster.capacity.heating_ratio()
+
+    def _schedule_batch(self, sig, req_batch, policy, stats, *,
+                        delay_sched, delay, provision_gap,
+                        evict_policy, evict_th, lb_ratio):
+        """Schedule a batch of (submit_tick, req_index) at tick sig. Returns
+        the requests to retry and the (ddl, node_index) of each placement."""
+        retry_queue, placements = [], []
+        for submit_tick, req_index in req_batch:
+            req = self.req_list[req_index]
+            # fast check if all nodes are full at the moment
+            if self.is_all_full(self.cluster):
+                retry_queue.append((submit_tick if submit_tick < sig else sig, req_index))
+                continue
+
+            # scheduler finds the node to place the request, -1 if failed
+            start = time.perf_counter()
+            node_index = self.sched.schedule(req, self.cluster,
+                                             policy, lb_ratio=lb_ratio,
+                                             req_index=req_index, tick=sig)
+            stats["sched_time"] += time.perf_counter() - start
+            stats["sched_num"] += 1
+            if node_index < 0:
+                self.ty.report_rej(node_index)
+                retry_queue.append((submit_tick if submit_tick < sig else sig, req_index))
+                continue
+
+            node = self.cluster[node_index]
+            provision_lat = self.calc_latency(req, node)
+            wait_time = (sig - submit_tick) * 1000
+
+            # delay scheduling
+            if delay_sched and policy in DEP_POLICIES:
+                # if the "best" node found still yields too high startup latency, wait a bit
+                if provision_lat > provision_gap * (1 + wait_time) and wait_time <= delay * 1000:
+                    retry_queue.append((submit_tick if submit_tick < sig else sig, req_index))
+                    continue
+            # node placement
+            required_size, ddl = self.place_node(sig, req, node)
+            placements.append((ddl, node_index))
+            if node.used + required_size > node.cap * (1 - evict_th):
+                free_size = self.evict_node(node,
+                                            evict_policy=evict_policy,
+                                            )
+            # collect metrics
+            lat = provision_lat + wait_time
+            stats["total_lat"] += lat
+            stats["total_provision_lat"] += provision_lat
+            stats["accept_req_num"] += 1
+            self.tr.add_lat_result(lat)
+            self.tr.add_provision_lat_result(provision_lat)
+            self.ty.report_req(req)
+        return retry_queue, placements
+
+    def check_cluster(self):
+        """Validate the incrementally kept node states against a full
+        recomputation; time consuming, see check_interval."""
+        ix = self.tr.ix
+        for node in self.cluster:
+            refs = defaultdict(int)
+            for image in node.images:
+                for l in ix.image_layers(image):
+                    refs[l] += 1
+            assert refs == node.layer_refs, \
+                "--> layer refs mismatch on node {}.".format(node.index)
+            used = sum([ix.layer_size(l) for l in node.layers])
+            assert used == node.used, \
+                "--> total layer size mismatch on node {}. {}/{}".format(node.index, used, node.used)
+
+    def _check(self, tick):
+        if self.check_interval > 0 and tick >= self.next_check:
+            self.check_cluster()
+            self.next_check = tick + self.check_interval
+
+    def _snap(self, tick, node_heatings):
+        if 0.0 * len(self.req_seq) < tick < len(self.req_seq) and tick % self.snap_interval == 0:
+            node_heatings.add(self.node_heating_ratio())
+            self.ty.tel_node_snap(self.cluster, image=False)
+
+    def _run_tick(self, policy, stats, node_heatings, *,
+                  max_sim_duration, evict_policy, **sched_args):
+        """Advance the cluster one second at a time; every tick updates
+        every node. Returns the last tick."""
+        retry_queue, req_seq_pos = [], 0
+
+        # simulation loop
+        for tick in range(max_sim_duration):
+            # update cluster states, using t as the event signal
+            sig = tick
+            self._snap(tick, node_heatings)
+            self._check(tick)
+            self.update_nodes(sig, self.cluster, evict_policy=evict_policy, evict_th=self.evict_th)
+
+            if tick >= len(self.req_seq):
+                req_batch = []
+                if len(retry_queue) == 0:
+                    self.tr.set_metric("duration", tick)
+                    break
+            else:
+                # concatenate the retry_queue and the req_batch is equivalent of leaving
+                # unscheduled tasks in one single queue with new ones appended at the end
+                req_batch = [(sig, i) for i in range(req_seq_pos, req_seq_pos + self.req_seq[tick])]
+                req_seq_pos += self.req_seq[tick]
+
+            retry_queue, _ = self._schedule_batch(sig, retry_queue + req_batch, policy, stats,
+                                                  evict_policy=evict_policy, **sched_args)
+        return tick
+
+    def _run_event(self, policy, stats, node_heatings, *,
+                   max_sim_duration, evict_policy, **sched_args):
+        """Discrete-event equivalent of _run_tick. A tick is visited only if
+        requests arrive, containers expire or retries are pending, and only
+        the nodes touched by those events are updated. Idle ticks are
+        skipped; the cluster state cannot change during them, since eviction
+        on an untouched node is a no-op. Returns the last tick."""
+        num_tick = len(self.req_seq)
+        arrivals = [t for t, n in enumerate(self.req_seq) if n > 0]
+        offsets = np.cumsum([0] + self.req_seq).tolist()
+        arrival_pos, retry_queue = 0, []
+
+        # every node is evicted at the first tick, as in the tick engine
+        dirty = set(range(len(self.cluster))) if self.evict else set()
+        tick = 0
+        while tick < max_sim_duration:
+            sig = tick
+            self._snap(tick, node_heatings)
+            self._check(tick)
+
+            expired = self.cluster.pop_expired(sig)
+            touched = dirty | expired.keys()
+            self.update_nodes(sig, [self.cluster[i] for i in sorted(touched)], expired=expired,
+                              evict_policy=evict_policy, evict_th=self.evict_th)
+
+            if tick >= num_tick:
+                req_batch = []
+                if len(retry_queue) == 0:
+                    self.tr.set_metric("duration", tick)
+                    break
+            else:
+                req_batch = [(sig, i) for i in range(offsets[tick], offsets[tick + 1])]
+
+            retry_queue, placements = self._schedule_batch(sig, retry_queue + req_batch, policy, stats,
+                                                           evict_policy=evict_policy, **sched_args)
+            dirty = set(i for _, i in placements) if self.evict else set()
+
+            # find the next tick having any event
+            while arrival_pos < len(arrivals) and arrivals[arrival_pos] <= tick:
+                arrival_pos += 1
+            if retry_queue or dirty:
+                next_tick = tick + 1
+            else:
+                # the first tick past the request sequence ends the run
+                next_tick = max(tick + 1, num_tick)
+                if arrival_pos < len(arrivals):
+                    next_tick = min(next_tick, arrivals[arrival_pos])
+                next_expiry = self.cluster.next_expiry()
+                if next_expiry is not None:
+                    next_tick = min(next_tick, next_expiry)
+            next_tick = min(next_tick, max_sim_duration)
+
+            # skipped ticks see the same cluster state
+            for t in range(tick + 1, min(next_tick, num_tick)):
+                self._snap(t, node_heatings)
+            tick = next_tick
+        return tick
+
+    def _runner(self, engine):
+        if engine == "tick":
+            return self._run_tick
+        elif engine == "event":
+            return self._run_event
+        raise Exception("--> unknown simulation engine: {}.".format(engine))
+
+    def _sim_policy(self, policy, *, max_sim_duration, engine, evict_policy, **sched_args):
+        """Run one policy on the current cluster; write out its results and
+        return its quick results. The cluster is left as the run ends."""
+        quick_results = defaultdict(list)
+
+        # reset metric and counters
+        self.ty.reset()
+        self.sched.set_stream(self.seed, policy)
+        if isinstance(self.req_list, LazyRequests):
+            self.req_list.rewind()
+        stats = {"total_lat": 0, "total_provision_lat": 0, "accept_req_num": 0,
+                 "sched_time": 0, "sched_num": 0}
+        # streamed, only the p99 is reported
+        node_heatings = LatencyHistogram()
+        self.next_check = 0
+
+        tick = self._runner(engine)(policy, stats, node_heatings,
+                                    max_sim_duration=max_sim_duration,
+                                    evict_policy=evict_policy if policy in DEP_POLICIES else "kube",
+                                    **sched_args)
+        total_lat, total_provision_lat, accept_req_num = \
+            stats["total_lat"], stats["total_provision_lat"], stats["accept_req_num"]
+
+        # collect results
+        if tick == max_sim_duration:
+            print("--> max sim duration hit.")
+            quick_results["util"].append(1)
+
+        mean_startup_lat = -1.0
+        if accept_req_num != 0:
+            mean_startup_lat = round(total_lat / accept_req_num)
+
+        mean_provision_lat = -1.0
+        if accept_req_num != 0:
+            mean_provision_lat = round(total_provision_lat / accept_req_num)
+
+        self.tr.set_metric("mean_lat", mean_startup_lat) \
+            .set_metric("mean_provision_lat", mean_provision_lat) \
+            .set_metric("accept_req_num", accept_req_num) \
+            .set_setup_metric("sched_policy", policy)
+
+        quick_results["util"].append(self.ty.tel_util(total_provision_lat))
+        quick_results["mean_provision_lat"].append(mean_provision_lat)
+        quick_results["mean_startup_lat"].append(mean_startup_lat)
+        # scheduling throughput, the schedule calls per second spent in them;
+        # wall-clock, so only reported when asked for
+        if self.sched_rate:
+            quick_results["sched_rate"].append(
+                round(stats["sched_num"] / stats["sched_time"]) if stats["sched_time"] else -1)
+
+        # print and write out results
+        self.ty.tel_blank()
+        self.ty.tel_gc()
+        self.ty.tel_rej()
+        # self.ty.tel_nodes(self.cluster, "last")
+        self.tr.cal_lat_percentile()
+        self.tr.dump_meta_result(policy)
+        self.tr.dump_lat_result(policy)
+
+        self.ty.reduce_node_snap()
+        if len(node_heatings):
+            print(node_heatings.value_at_rank(int(0.99 * len(node_heatings))))
+        return quick_results
 
     def _sim(self, *, max_sim_duration=10 ** 10,
              delay_sched=False, delay=0, provision_gap=5,
@@ -332,129 +650,48 @@ class Simulator:
              evict_th=0.1,
              lb_ratio=None,
              hot_duration=0,
+             engine="tick",
+             parallel=False,
              ):
-        # save a deep copy of the node list
-        node_list = copy.deepcopy(self.node_list)
+        self._runner(engine)
 
         # store the results of interests such that the experiments can
         # conveniently obtain the them after a single run
         quick_results = defaultdict(list)
-
-        for policy in policies:
-            # reset metric and counters
-            self.ty.reset()
-            total_lat, total_provision_lat, accept_req_num, req_seq_pos = 0, 0, 0, 0
-            evict_policy = evict_policy if policy == "dep" else "kube"
-            retry_queue = []
-            node_heatings = []
-
-            # simulation loop
-            for tick in range(max_sim_duration):
-                # print(tick)
-                # update cluster states, using t as the event signal
-                sig = tick
-                # print(self.node_heating_ratio())
-                # if 0.5 * len(self.req_seq) < tick < len(self.req_seq):
-                #     self.ty.tel_node_snap(self.node_list, image=True)
-
-                if 0.0 * len(self.req_seq) < tick < len(self.req_seq):
-                    node_heatings.append(self.node_heating_ratio())
-                    self.ty.tel_node_snap(self.node_list, image=False)
-
-                self.update_nodes(sig, self.node_list, evict_policy=evict_policy, evict_th=self.evict_th)
-
-                sig, req_node_pairs = tick, []
-                if tick >= len(self.req_seq):
-                    req_batch = []
-                    if len(retry_queue) == 0:
-                        self.tr.set_metric("duration", tick)
-                        break
-                else:
-                    # concatenate the retry_queue and the req_batch is equivalent of leaving
-                    # unscheduled tasks in one single queue with new ones appended at the end
-                    req_batch = [(sig, req) for req in self.req_list[req_seq_pos:req_seq_pos + self.req_seq[tick]]]
-                    req_seq_pos += self.req_seq[tick]
-
-                # print(len(retry_queue))
-                req_batch = retry_queue + req_batch
-                retry_queue = []
-
-                # scheduling loop
-                for submit_tick, req in req_batch:
-                    # fast check if all nodes are full at the moment
-                    if self.is_all_full(self.node_list):
-                        retry_queue.append((submit_tick if submit_tick < sig else sig, req))
-                        continue
-
-                    # scheduler finds the node to place the request, -1 if failed
-                    node_index = self.sched.schedule(req, self.node_list,
-                                                     policy, lb_ratio=lb_ratio)
-                    if node_index < 0:
-                        self.ty.report_rej(node_index)
-                        retry_queue.append((submit_tick if submit_tick < sig else sig, req))
-                        continue
-
-                    node = self.node_list[node_index]
-                    provision_lat = self.calc_latency(req, node)
-                    wait_time = (sig - submit_tick) * 1000
-
-                    # delay scheduling
-                    if delay_sched and policy is "dep":
-                        # if the "best" node found still yields too high startup latency, wait a bit
-                        if provision_lat > provision_gap * (1 + wait_time) and wait_time <= delay * 1000:
-                            retry_queue.append((submit_tick if submit_tick < sig else sig, req))
-                            continue
-                    # node placement
-                    required_size = self.place_node(sig, req, node)
-                    if node[2] + required_size > node[3] * (1 - evict_th):
-                        free_size = self.evict_node(node,
-                                                    evict_policy=evict_policy,
-                                                    )
-                    # collect metrics
-                    lat = provision_lat + wait_time
-                    total_lat += lat
-                    total_provision_lat += provision_lat
-                    accept_req_num += 1
-                    self.tr.add_lat_result(lat)
-                    self.tr.add_provision_lat_result(provision_lat)
-                    self.ty.report_req(req)
-                    # end of simulation loop
-
-            # collect results
-            if tick == max_sim_duration:
-                print("--> max sim duration hit.")
-                quick_results["util"].append(1)
-
-            mean_startup_lat = -1.0
-            if accept_req_num != 0:
-                mean_startup_lat = round(total_lat / accept_req_num)
-
-            mean_provision_lat = -1.0
-            if accept_req_num != 0:
-                mean_provision_lat = round(total_provision_lat / accept_req_num)
-
-            self.tr.set_metric("mean_lat", mean_startup_lat) \
-                .set_metric("mean_provision_lat", mean_provision_lat) \
-                .set_metric("accept_req_num", accept_req_num) \
-                .set_setup_metric("sched_policy", policy)
-
-            quick_results["util"].append(self.ty.tel_util(total_provision_lat))
-            quick_results["mean_provision_lat"].append(mean_provision_lat)
-            quick_results["mean_startup_lat"].append(mean_startup_lat)
-
-            # print and write out results
-            self.ty.tel_blank()
-            self.ty.tel_gc()
-            self.ty.tel_rej()
-            # self.ty.tel_nodes(self.node_list, "last")
-            self.tr.cal_lat_percentile()
-            self.tr.dump_meta_result(policy)
-            self.tr.dump_lat_result(policy)
-
-            # reset the internal node_list
-            self.node_list = copy.deepcopy(node_list)
-            self.ty.reduce_node_snap()
-            print(np.percentile(node_heatings, 99))
+        policy_args = dict(max_sim_duration=max_sim_duration,
+                           engine=engine,
+                           evict_policy=evict_policy,
+                           delay_sched=delay_sched,
+                           delay=delay,
+                           provision_gap=provision_gap,
+                           evict_th=evict_th,
+                           lb_ratio=lb_ratio)
+
+        if parallel and len(policies) > 1:
+            global _forked
+            _forked = self
+            try:
+                ctx = multiprocessing.get_context("fork")
+                with ctx.Pool(len(policies)) as pool:
+                    outs = pool.map(_sim_policy_worker, [(p, policy_args) for p in policies])
+            finally:
+                _forked = None
+            # merge in the policy order, as if the policies ran in turn
+            for out in outs:
+                for k, v in out["quick_results"].items():
+                    quick_results[k].extend(v)
+                self.tr.merge_provision_lat_result(out["provision_lat"])
+                self.tr.metric_map.update(out["metric_map"])
+                self.tr.metric_setup_map.update(out["metric_setup_map"])
+                vars(self.ty).update(out["telemetry"])
+        else:
+            # journal the cluster such that each policy starts from the same state
+            self.cluster.snapshot()
+            for policy in policies:
+                for k, v in self._sim_policy(policy, **policy_args).items():
+                    quick_results[k].extend(v)
+                # reset the internal cluster
+                self.cluster.restore()
         if len(policies) > 1:
             baseline = None
             for i, data in enumerate(quick_results["mean_startup_lat"]):
@@ -475,11 +712,56 @@ class Simulator:
             max_num_image=1,
             evict_policy="dep-lru",
             provision_gap=1, zipf=False, lb_ratio=None,
-            hot_duration=0):
+            hot_duration=0, engine="tick", score_mode="loop",
+            check_interval=0, expiry="round", parallel=False,
+            seed=None, rng="seeder", tie_break="permutation", sample_k=16, sched_rate=False, lat_mode="exact",
+            result_format="csv", snap_interval=1, workload_cache=False, workload_gen="loop",
+            replay_file=None, replay_tick=1.0):
         """
         simulation modes:
             warmup: start with empty nodes
             precache: start with nodes containing caches
+        engines:
+            tick: update every node every second
+            event: visit only the ticks and nodes having events; same results
+        score modes (see schedule.Scheduler):
+            loop, matrix, postings; same results
+        parallel:
+            run each policy in a forked worker process, same results; needs
+            rng="philox", as with the seeder rng each worker would start
+            the scheduler seeds afresh
+        scheduler randomness (see schedule.Scheduler):
+            rng, seeder or philox
+            tie_break, permutation or random
+            sample_k, the random nodes dep-sampled and kube-sampled score
+            sched_rate, report the schedule calls per second of each policy
+            in the quick results; wall-clock, not reproducible
+        latencies:
+            lat_mode, exact keeps every latency, for small runs; histogram
+            keeps a log-linear histogram in fixed memory, the percentiles
+            then within 0.4% of the exact ones
+            result_format, csv, a latency per line; npy, an array per
+            policy plus a json sidecar of the metric maps, see plot.py
+        container expiry:
+            round, deadlines rounded to the second, as before
+            precise, deadlines kept with the sub-second provisioning latency
+        checks:
+            check_interval, validate the node states every given ticks; 0 disables
+        telemetry:
+            snap_interval, sample the node states every given ticks
+        workloads:
+            workload_cache, with a seed, load the requests from the on-disk
+            cache (WORKLOAD_CACHE) if generated before, else store them;
+            entries are never evicted
+            workload_gen, loop draws request by request, as before; vector
+            draws the same distributions in batched numpy calls, see
+            workload.generate, for other samples; stream draws each request
+            when scheduled, never holding the workload, see
+            workload.RequestStream; use it with lat_mode="histogram" for
+            long runs; replay reads the requests from the jsonl log
+            replay_file, bucketed in ticks of replay_tick seconds, see
+            workload.ReplayStream; sim_length and req_rate are then those
+            of the log
         metrices:
             req_num, accept_req_num
             mean_lat(ency), total_lat
@@ -487,11 +769,38 @@ class Simulator:
         """
         # parameter checks
         # 1 gb is the assumed largest container image size
+        if parallel and rng == "seeder":
+            raise Exception("--> parallel runs need rng=\"philox\" to match a serial run.")
+
+        # seed the workload generation, e.g., per sweep point; also keys
+        # the scheduler streams with rng="philox"
+        if seed is not None:
+            random.seed(seed)
+            np.random.seed(seed)
+        self.seed = seed
+        self.workload_cache = workload_cache
+        if workload_gen not in ("loop", "vector", "stream", "replay"):
+            raise Exception("--> unknown workload generation: {}.".format(workload_gen))
+        if workload_gen == "replay" and replay_file is None:
+            raise Exception("--> replay needs a replay_file.")
+        self.workload_gen = workload_gen
+        self.replay_file = replay_file
+        self.replay_tick = replay_tick
+        self.sched_rate = sched_rate
 
         self.tr.set_result_dir(result_dir)
         self.evict = evict
         self.evict_th = evict_th
         self.evict_dep = evict_dep
+        self.check_interval = check_interval
+        assert snap_interval >= 1, "--> snap_interval must be positive."
+        self.snap_interval = snap_interval
+        if expiry not in ("round", "precise"):
+            raise Exception("--> unknown container expiry: {}.".format(expiry))
+        self.expiry = expiry
+        if lat_mode != self.tr.lat_mode:
+            self.tr.set_lat_mode(lat_mode)
+        self.tr.set_result_format(result_format)
 
         if rerun:
             self.update_cluster(
@@ -514,6 +823,8 @@ class Simulator:
                               cached_rank=cached_rank)
             self.init_req_queue(sim_length, uniform=uniform, cont_length=cont_length,
                                 req_rate=req_rate, zipf=zipf, max_num_image=max_num_image)
+        if workload_gen == "replay":
+            sim_length, req_rate = self.sim_length, self.req_rate
 
         self.tr.set_setup_metric("sim_length", sim_length) \
             .set_setup_metric("req_rate", req_rate) \
@@ -535,10 +846,28 @@ class Simulator:
             .set_setup_metric("provision_gap", provision_gap) \
             .set_setup_metric("lb_ratio", lb_ratio) \
             .set_setup_metric("hot_duration", hot_duration) \
+            .set_setup_metric("engine", engine) \
+            .set_setup_metric("score_mode", score_mode) \
+            .set_setup_metric("check_interval", check_interval) \
+            .set_setup_metric("expiry", expiry) \
+            .set_setup_metric("parallel", parallel) \
+            .set_setup_metric("seed", seed) \
+            .set_setup_metric("rng", rng) \
+            .set_setup_metric("tie_break", tie_break) \
+            .set_setup_metric("sample_k", sample_k) \
+            .set_setup_metric("sched_rate", sched_rate) \
+            .set_setup_metric("lat_mode", lat_mode) \
+            .set_setup_metric("result_format", result_format) \
+            .set_setup_metric("snap_interval", snap_interval) \
+            .set_setup_metric("workload_cache", workload_cache) \
+            .set_setup_metric("workload_gen", workload_gen) \
+            .set_setup_metric("replay_file", replay_file) \
+            .set_setup_metric("replay_tick", replay_tick) \
             .set_metric("accept_req_num", 0) \
             .set_metric("mean_lat", 0)
 
-        self.sched = Scheduler(self.tr, dep_th)
+        self.sched = Scheduler(self.tr, dep_th, score_mode=score_mode,
+                               rng=rng, tie_break=tie_break, sample_k=sample_k)
         self.ty = Telemetry(tracer=self.tr, verbose=0)
         print("--> running simulation..")
 
@@ -548,22 +877,23 @@ class Simulator:
                          policies=policies,
                          evict_policy=evict_policy,
                          lb_ratio=lb_ratio,
-                         hot_duration=hot_duration)
+                         hot_duration=hot_duration,
+                         engine=engine,
+                         parallel=parallel)
 
     def update_cluster(self, node_num, *, store_size, cont_cap, precached, cached_rank, pinned):
-        if node_num != len(self.node_list) or self.tr.get_metric("cached_rank") != cached_rank \
+        if node_num != len(self.cluster) or self.tr.get_metric("cached_rank") != cached_rank \
                 or self.tr.get_metric("precached") != precached:
             self.init_cluster(node_num, store_size=store_size,
                               cont_cap=cont_cap, precached=precached, cached_rank=cached_rank, pinned=pinned)
             return
         if self.tr.get_metric("store_size") != str(store_size / gb) + "GB":
-            for n in self.node_list:
-                n[3] = store_size
+            self.cluster.cap[:] = store_size
             print("--> updated layer store capacity.")
         if self.tr.get_metric("cont_cap") != cont_cap:
-            for n in self.node_list:
-                n[5] = cont_cap
+            self.cluster.max_conta[:] = cont_cap
             print("--> updated container capacity.")
+        self.cluster.capacity.rebuild()
 
     def update_req_queue(
             self,
@@ -573,7 +903,7 @@ class Simulator:
             req_rate,
             zipf,
             max_num_image):
-        if sim_length != self.sim_length or req_rate != self.req_rate or self.tr.get_metric(
+        if self.workload_gen == "replay" or sim_length != self.sim_length or req_rate != self.req_rate or self.tr.get_metric(
                 "is_uniform") != uniform or self.tr.get_metric("zipf") != zipf:
             self.init_req_queue(
                 sim_length,
@@ -584,6 +914,10 @@ class Simulator:
                 max_num_image=max_num_image)
             return
         if self.tr.get_metric("cont_length") != cont_length:
+            if isinstance(self.req_list, RequestStream):
+                self.init_req_queue(sim_length, uniform=uniform, cont_length=cont_length,
+                                    req_rate=req_rate, zipf=zipf, max_num_image=max_num_image)
+                return
             for i in range(len(self.req_list)):
                 self.req_list[i] = (self.req_list[i][0],
                                     int(random.random() * cont_length + 1))
@@ -607,6 +941,29 @@ class Simulator:
         return results
 
 
+# the simulator the policy workers fork from, see Simulator._sim; the trace,
+# requests and cluster are inherited copy-on-write instead of pickled
+_forked = None
+
+
+def _sim_policy_worker(args):
+    policy, policy_args = args
+    s = _forked
+    num_provision_lat = len(s.tr.provision_lat_list)
+    if s.tr.provision_lat_hist is not None:
+        # count this policy alone, the parent merges it in
+        s.tr.provision_lat_hist = LatencyHistogram()
+    quick_results = s._sim_policy(policy, **policy_args)
+    return {
+        "quick_results": dict(quick_results),
+        "provision_lat": s.tr.provision_lat_hist if s.tr.provision_lat_hist is not None
+        else s.tr.provision_lat_list[num_provision_lat:],
+        "metric_map": dict(s.tr.metric_map),
+        "metric_setup_map": dict(s.tr.metric_setup_map),
+        "telemetry": {k: v for k, v in vars(s.ty).items() if k != "tr"},
+    }
+
+
 def main():
     print("--> please run via cmd.py")
 
@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 from __future__ import print_function
-from collections import defaultdict
 from .schedule import REJ_CONT_LIMIT, REJ_STORE_LIMIT
 from .utils import gb, mb
 import os
@@ -11,6 +10,9 @@ import numpy as np
 _dir_path = os.path.dirname(os.path.realpath(__file__))
 _result_path = _dir_path + "/__plot__/__data__/"
 
+# the per-node series sampled by tel_node_snap, in row order
+SNAP_METRICS = ("num_image", "real_free_space", "free_space")
+
 class Telemetry:
     def __init__(self, tracer=None, verbose=0):
         self.verbose = verbose
@@ -22,8 +24,13 @@ class Telemetry:
         self.rej_store_cnt = 0
         self.gc_cnt = 0
         self.gc_size = 0
-        self.admit_reqs = []
-        self.node_snaps = defaultdict(list)
+        # container seconds of the admitted requests
+        self.admit_runtime = 0
+        # per node and metric running mean and squared deviations (Welford),
+        # instead of keeping every snapshot
+        self.num_snap = 0
+        self.snap_mean = None
+        self.snap_m2 = None
 
     def report_rej(self, code):
         if code == REJ_CONT_LIMIT:
@@ -42,12 +49,10 @@ class Telemetry:
         pass
 
     def report_req(self, req):
-        self.admit_reqs.append(req)
+        self.admit_runtime += len(req[0]) * req[1]
 
     def tel_util(self, total_provision_time=0):
-        total_runtime, total_provision_time = 0, total_provision_time/1000
-        for req in self.admit_reqs:
-            total_runtime += len(req[0]) * req[1]
+        total_runtime, total_provision_time = self.admit_runtime, total_provision_time/1000
         total_cont_time = self.tr.get_metric("node_num") * \
                 self.tr.get_metric("duration") * \
                 self.tr.get_metric("cont_cap")
@@ -73,11 +78,10 @@ class Telemetry:
         layer_store_histo = []
         contn_histo = []
         prefix = "--> Round " + str(rnd) + ": "
-        for i in range(len(nodes)):
-            images, layers = nodes[i][0], nodes[i][1]
-            image_histo.append(len(images))
-            layer_histo.append(len(layers))
-            layer_store_histo.append((nodes[i][3] - nodes[i][2]) / mb)
+        for node in nodes:
+            image_histo.append(len(node.images))
+            layer_histo.append(len(node.layers))
+        layer_store_histo = ((nodes.cap - nodes.used) / mb).tolist()
 
         print("".join(["="] * 30))
         if verbose >= 1:
@@ -97,29 +101,30 @@ class Telemetry:
         return
 
     def tel_node_snap(self, nodes, image=False):
-        for i, n in enumerate(nodes):
-            num_image = len(n[0])
-            real_free_space = n[-1] / mb
-            free_space = (n[3] - n[2]) / mb
-            if i not in self.node_snaps:
-                self.node_snaps[i] = {
-                    "num_image": [],
-                    "real_free_space": [],
-                    "free_space": [],
-                }
-            self.node_snaps[i]["num_image"].append(num_image)
-            self.node_snaps[i]["real_free_space"].append(real_free_space)
-            self.node_snaps[i]["free_space"].append(free_space)
+        sample = np.empty((len(SNAP_METRICS), len(nodes)))
+        sample[0] = [len(n.images) for n in nodes]
+        sample[1] = nodes.real_free / mb
+        sample[2] = (nodes.cap - nodes.used) / mb
+        if self.snap_mean is None:
+            self.snap_mean = np.zeros_like(sample)
+            self.snap_m2 = np.zeros_like(sample)
+        self.num_snap += 1
+        delta = sample - self.snap_mean
+        self.snap_mean += delta / self.num_snap
+        self.snap_m2 += delta * (sample - self.snap_mean)
+
+    def snap_std(self):
+        """ per node and metric standard deviation over the snapshots """
+        return np.sqrt(self.snap_m2 / self.num_snap)
 
     def reduce_node_snap(self):
-        mean_num_image, mean_real_free_space, mean_free_space = [], [], []
-        for _, s in self.node_snaps.items():
-            mean_num_image.append(np.mean(s["num_image"]))
-            mean_free_space.append(np.mean(s["free_space"]))
-            mean_real_free_space.append(np.mean(s["free_space"]))
-        print("mean image: ", np.mean(mean_num_image))
-        print("mean real free space: ", np.mean(mean_real_free_space))
-        print("mean free space: ", np.mean(mean_free_space))
+        if self.num_snap == 0:
+            print("--> no node snapshots.")
+            return
+        mean_num_image, mean_real_free_space, mean_free_space = self.snap_mean.mean(axis=1)
+        print("mean image: ", mean_num_image)
+        print("mean real free space: ", mean_real_free_space)
+        print("mean free space: ", mean_free_space)
 
     def tel_blank(self):
         print("\n")
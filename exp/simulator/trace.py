@@ -3,13 +3,16 @@
 from __future__ import print_function
 
 import cloudpickle as pickle
+import hashlib
+import json
 import os
 import random
-from collections import defaultdict, namedtuple
+from collections import OrderedDict, defaultdict, namedtuple
 
 import numpy as np
 import redis
 
+from .histogram import LatencyHistogram
 from .utils import dir_check, ts_gen, time_func, gb, mb, Singleton
 from ..share_study.ecr import ECRImageDB
 
@@ -28,6 +31,252 @@ META_RESULTS = "./__result__/out_meta"
 MAX_IMAGE_SIZE = 10.2 * gb
 _dir_path = os.path.dirname(os.path.realpath(__file__))
 _result_path = _dir_path + "/__plot__/__data__/"
+# the on-disk trace snapshot, see TraceIndex.dump; bump the version on any
+# layout change, stale snapshots are then ignored
+TRACE_SNAPSHOT = os.environ.get("TRACE_SNAPSHOT", _dir_path + "/__trace__/trace.bin")
+TRACE_VERSION = 1
+_TRACE_MAGIC = b"DEPTRACE"
+_TRACE_ALIGN = 64
+
+
+def _json_value(value):
+    # numpy scalars in the metric maps, anything else as its string
+    return value.item() if isinstance(value, np.generic) else str(value)
+
+
+class TraceIndex:
+    """Interned trace: images and layers are dense int ids, assigned in
+    name/digest order. The image->layers and layer->images adjacency is
+    kept in CSR form (offsets plus int32 ids), the per-image and per-layer
+    values in NumPy vectors. Scalar lookups go through list mirrors of the
+    vectors so the simulation loops keep plain Python numbers.
+
+    The arrays can be dumped into a snapshot file and memory-mapped back,
+    without parsing; processes mapping the same file share its pages."""
+
+    fields = ("image_names", "layer_digests",
+              "image_layer_ptr", "image_layer_idx",
+              "layer_image_ptr", "layer_image_idx",
+              "image_pops", "image_sizes", "layer_pops", "layer_sizes",
+              "layer_dl_times", "layer_reg_times", "listed")
+    plan_cache_size = 1 << 14
+
+    def __init__(self, image_names, layer_digests,
+                 image_layer_ptr, image_layer_idx,
+                 layer_image_ptr, layer_image_idx,
+                 image_pops, image_sizes, layer_pops, layer_sizes,
+                 layer_dl_times, layer_reg_times, listed):
+        # sorted byte strings; the lookups are binary searches
+        self.image_names = image_names
+        self.layer_digests = layer_digests
+        self.image_layer_ptr = image_layer_ptr
+        self.image_layer_idx = image_layer_idx
+        self.layer_image_ptr = layer_image_ptr
+        self.layer_image_idx = layer_image_idx
+        self.image_pops = image_pops
+        self.image_sizes = image_sizes
+        self.layer_pops = layer_pops
+        self.layer_sizes = layer_sizes
+        self.layer_dl_times = layer_dl_times
+        self.layer_reg_times = layer_reg_times
+        # ids of the images in the (filtered) image list, in list order
+        self.listed = listed
+
+        self._image_size = image_sizes.tolist()
+        self._layer_size = layer_sizes.tolist()
+        self._layer_dl_time = layer_dl_times.tolist()
+        self._layer_reg_time = layer_reg_times.tolist()
+        self._image_layers = {}
+        self._plans = OrderedDict()
+
+    @classmethod
+    def from_maps(cls, imageinfo_map, layerinfo_map, layerpull_map, image_list):
+        names = sorted(imageinfo_map)
+        digests = sorted(set(layerinfo_map).union(
+            *[entry[2] for entry in imageinfo_map.values()]))
+        image_names = np.array([n.encode() for n in names])
+        layer_digests = np.array([d.encode() for d in digests])
+        image_index = {n: i for i, n in enumerate(names)}
+        layer_index = {d: i for i, d in enumerate(digests)}
+
+        def csr(keys, members, index):
+            ptr, idx = [0], []
+            for k in keys:
+                ids = sorted(index[m] for m in members(k) if m in index)
+                idx.extend(ids)
+                ptr.append(len(idx))
+            return np.array(ptr, dtype=np.int64), np.array(idx, dtype=np.int32)
+
+        image_layer_ptr, image_layer_idx = csr(names, lambda n: imageinfo_map[n][2], layer_index)
+        layer_image_ptr, layer_image_idx = csr(
+            digests, lambda d: layerinfo_map[d][2] if d in layerinfo_map else (), image_index)
+
+        def layer_value(d, pos):
+            return layerinfo_map[d][pos] if d in layerinfo_map else 0
+
+        def pull_value(d, pos):
+            return layerpull_map[d][pos] if d in layerpull_map else 0
+
+        return cls(image_names, layer_digests,
+                   image_layer_ptr, image_layer_idx,
+                   layer_image_ptr, layer_image_idx,
+                   image_pops=np.array([imageinfo_map[n][0] for n in names]),
+                   image_sizes=np.array([imageinfo_map[n][1] for n in names]),
+                   layer_pops=np.array([layer_value(d, 0) for d in digests]),
+                   layer_sizes=np.array([layer_value(d, 1) for d in digests]),
+                   layer_dl_times=np.array([pull_value(d, 0) for d in digests]),
+                   layer_reg_times=np.array([pull_value(d, 1) for d in digests]),
+                   listed=np.array([image_index[n] for n in dict.fromkeys(image_list)],
+                                   dtype=np.int32))
+
+    def dump(self, path, image_list):
+        """Write the arrays and the image list (as ids, in list order) to
+        path: the magic, a little-endian u64 header length, a json header
+        of {name: [dtype, shape, offset]}, then the raw arrays, aligned."""
+        arrays = [(f, np.ascontiguousarray(getattr(self, f))) for f in self.fields]
+        arrays.append(("image_list", np.array([self.image_id(n) for n in image_list], dtype=np.int32)))
+        layout, offset = {}, 0
+        for name, a in arrays:
+            layout[name] = [a.dtype.str, list(a.shape), offset]
+            offset += -(-a.nbytes // _TRACE_ALIGN) * _TRACE_ALIGN
+        header = json.dumps({"version": TRACE_VERSION, "arrays": layout}).encode()
+        start = -(-(len(_TRACE_MAGIC) + 8 + len(header)) // _TRACE_ALIGN) * _TRACE_ALIGN
+
+        dir_check(os.path.dirname(path) + "/")
+        tmp = path + ".{}.tmp".format(os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(_TRACE_MAGIC)
+            f.write(np.uint64(len(header)).astype("<u8").tobytes())
+            f.write(header)
+            for name, a in arrays:
+                f.seek(start + layout[name][2])
+                f.write(a.tobytes())
+            f.truncate(start + offset)
+        # readers never see a partial snapshot
+        os.replace(tmp, path)
+
+    @classmethod
+    def mmap(cls, path):
+        """The index and the image list ids of a snapshot file; the arrays
+        are read-only views of the mapped file."""
+        buf = np.memmap(path, dtype=np.uint8, mode="r")
+        head = len(_TRACE_MAGIC) + 8
+        if bytes(buf[:len(_TRACE_MAGIC)]) != _TRACE_MAGIC:
+            raise Exception("--> not a trace snapshot: {}.".format(path))
+        header_len = int(buf[len(_TRACE_MAGIC):head].view("<u8")[0])
+        header = json.loads(bytes(buf[head:head + header_len]).decode())
+        if header["version"] != TRACE_VERSION:
+            raise Exception("--> trace snapshot version {}, expected {}: {}.".format(
+                header["version"], TRACE_VERSION, path))
+        start = -(-(head + header_len) // _TRACE_ALIGN) * _TRACE_ALIGN
+
+        arrays = {}
+        for name, (dtype, shape, offset) in header["arrays"].items():
+            dtype = np.dtype(dtype)
+            nbytes = dtype.itemsize * int(np.prod(shape))
+            arrays[name] = buf[start + offset:start + offset + nbytes].view(dtype).reshape(shape)
+        image_list = arrays.pop("image_list")
+        return cls(**arrays), image_list
+
+    @property
+    def num_image(self):
+        return len(self.image_names)
+
+    @property
+    def num_layer(self):
+        return len(self.layer_digests)
+
+    def _lookup(self, keys, key):
+        k = key.encode()
+        i = int(np.searchsorted(keys, k))
+        if i == len(keys) or keys[i] != k:
+            raise KeyError(key)
+        return i
+
+    def image_id(self, image):
+        return self._lookup(self.image_names, image)
+
+    def layer_id(self, digest):
+        return self._lookup(self.layer_digests, digest)
+
+    def image_name(self, image_id):
+        return self.image_names[image_id].decode()
+
+    def layer_digest(self, layer_id):
+        return self.layer_digests[layer_id].decode()
+
+    def image_layers(self, image_id):
+        """Layer ids of an image, ascending; memoized as a tuple."""
+        layers = self._image_layers.get(image_id)
+        if layers is None:
+            layers = tuple(self.image_layer_idx[self.image_layer_ptr[image_id]:
+                                                self.image_layer_ptr[image_id + 1]].tolist())
+            self._image_layers[image_id] = layers
+        return layers
+
+    def layer_images(self, layer_id):
+        return self.layer_image_idx[self.layer_image_ptr[layer_id]:self.layer_image_ptr[layer_id + 1]]
+
+    def image_size(self, image_id):
+        return self._image_size[image_id]
+
+    def layer_size(self, layer_id):
+        return self._layer_size[layer_id]
+
+    def layer_dl_time(self, layer_id):
+        return self._layer_dl_time[layer_id]
+
+    def layer_reg_time(self, layer_id):
+        return self._layer_reg_time[layer_id]
+
+    def layer_pull_time(self, layer_id):
+        return self._layer_dl_time[layer_id] + self._layer_reg_time[layer_id]
+
+    def request_plan(self, images):
+        """The RequestPlan of the image ids; memoized by the image tuple,
+        the last plan_cache_size used kept."""
+        key = tuple(images)
+        plans = self._plans
+        plan = plans.get(key)
+        if plan is not None:
+            plans.move_to_end(key)
+            return plan
+        plan = RequestPlan(self, key)
+        plans[key] = plan
+        if len(plans) > self.plan_cache_size:
+            plans.popitem(last=False)
+        return plan
+
+
+class RequestPlan:
+    """The layers a request needs, computed once for scheduling, latency
+    and placement: the distinct layer ids ascending, with their sizes,
+    pull times and the number of the request's images having each
+    (counts), and the request's total image size. A layer shared by two
+    images is pulled and stored once, but scored once per image.
+
+    score_versions and score_values cache the dep scores of the request on
+    the nodes, by node index, with the layer version each was taken at; None
+    unless the scheduler keeps the plan's scores, see Scheduler.cache_scores."""
+    __slots__ = ("images", "layers", "sizes", "pull_times", "counts", "weights", "weight_map",
+                 "total_size", "score_versions", "score_values")
+
+    def __init__(self, ix, images):
+        self.images = images
+        counts = defaultdict(int)
+        for i in images:
+            for l in ix.image_layers(i):
+                counts[l] += 1
+        self.layers = sorted(counts)
+        self.sizes = [ix.layer_size(l) for l in self.layers]
+        self.pull_times = [ix.layer_pull_time(l) for l in self.layers]
+        self.counts = [counts[l] for l in self.layers]
+        # the dep score weights, size per image having the layer
+        self.weights = [s * c for s, c in zip(self.sizes, self.counts)]
+        self.weight_map = dict(zip(self.layers, self.weights))
+        self.total_size = sum([ix.image_size(i) for i in images])
+        self.score_versions = None
+        self.score_values = None
 
 
 class Tracer(ECRImageDB, metaclass=Singleton):
@@ -35,25 +284,44 @@ class Tracer(ECRImageDB, metaclass=Singleton):
         self.image_pop_list = None
         self.image_pop_list_zipf = None
         self.layer_pop_list = None
+        # {bool_zipf: (image ids, popularities)}, and the ids of image_list
+        self.image_pop_ids = {}
+        self.image_list_ids = None
 
         self.metric_map = defaultdict()
         self.metric_setup_map = defaultdict()
+        # exact keeps every latency; histogram keeps them in fixed memory
+        # with a bounded relative error, see set_lat_mode
+        self.lat_mode = "exact"
         self.lat_list = []
         self.provision_lat_list = []
+        self.lat_hist = None
+        self.provision_lat_hist = None
+        # csv, a latency per line; npy, an array per metric plus a json sidecar
+        self.result_format = "csv"
 
         self.cdf = defaultdict(list)
         self.hist = defaultdict(list)
 
+        self._trace_digest = None
         self.load()
         print("--> tracer init.")
 
     def load(self):
+        # the snapshot file, if any, spares redis and the database
+        if os.path.exists(TRACE_SNAPSHOT):
+            try:
+                self.load_snapshot()
+                return
+            except Exception as e:
+                print(e, "falling back to redis.")
         try:
             self.load_from_redis()
             # self.load_from_db()
             # self.image_pop_list_zipf_()
         except:
             self.dump_to_redis()
+            del self.imageinfo_map, self.layerinfo_map, self.layerpull_map
             self.load_from_redis()
 
     @time_func
@@ -68,10 +336,60 @@ class Tracer(ECRImageDB, metaclass=Singleton):
     @time_func
     def load_from_redis(self):
         r = redis.StrictRedis(host='localhost')
-        self.imageinfo_map = pickle.loads(r.get("imageinfo"))
-        self.layerinfo_map = pickle.loads(r.get("layerinfo"))
-        self.layerpull_map = pickle.loads(r.get("layerpull"))
+        imageinfo_map = pickle.loads(r.get("imageinfo"))
+        layerinfo_map = pickle.loads(r.get("layerinfo"))
+        layerpull_map = pickle.loads(r.get("layerpull"))
         self.image_list = pickle.loads(r.get("imagelist"))
+        # only the interned index is kept; the maps are dropped here
+        self.ix = TraceIndex.from_maps(imageinfo_map, layerinfo_map, layerpull_map, self.image_list)
+        self._trace_digest = None
+
+    def trace_digest(self):
+        """Content hash of the loaded trace, e.g., to key the caches derived from it."""
+        if self._trace_digest is None:
+            h = hashlib.sha1(str(TRACE_VERSION).encode())
+            for f in TraceIndex.fields:
+                h.update(np.ascontiguousarray(getattr(self.ix, f)).tobytes())
+            h.update("\n".join(self.image_list).encode())
+            self._trace_digest = h.hexdigest()
+        return self._trace_digest
+
+    @time_func
+    def load_snapshot(self, path=None):
+        path = path or TRACE_SNAPSHOT
+        self.ix, image_list = TraceIndex.mmap(path)
+        self._trace_digest = None
+        names = self.ix.image_names
+        self.image_list = [names[i].decode() for i in image_list.tolist()]
+
+    def export_snapshot(self, path=None):
+        """Write the loaded trace to the snapshot file."""
+        path = path or TRACE_SNAPSHOT
+        self.ix.dump(path, self.image_list)
+        print("--> exported trace snapshot: {} images, {} layers to {}.".format(
+            self.ix.num_image, self.ix.num_layer, path))
+
+    def import_snapshot(self, path=None):
+        """Load the snapshot file, and write it back to redis as the maps
+        load_from_redis reads; the index built from them is the same."""
+        self.load_snapshot(path)
+        ix = self.ix
+        image_names = [ix.image_name(i) for i in range(ix.num_image)]
+        layer_digests = [ix.layer_digest(l) for l in range(ix.num_layer)]
+        pops, sizes = ix.image_pops.tolist(), ix.image_sizes.tolist()
+        imageinfo_map = {n: [pops[i], sizes[i], set(layer_digests[l] for l in ix.image_layers(i))]
+                         for i, n in enumerate(image_names)}
+        pops, sizes = ix.layer_pops.tolist(), ix.layer_sizes.tolist()
+        layerinfo_map = {d: [pops[l], sizes[l], set(image_names[i] for i in ix.layer_images(l).tolist())]
+                         for l, d in enumerate(layer_digests)}
+        layerpull_map = {d: (ix.layer_dl_time(l), ix.layer_reg_time(l)) for l, d in enumerate(layer_digests)}
+
+        r = redis.StrictRedis(host='localhost')
+        r.set("imageinfo", pickle.dumps(imageinfo_map))
+        r.set("layerinfo", pickle.dumps(layerinfo_map))
+        r.set("layerpull", pickle.dumps(layerpull_map))
+        r.set("imagelist", pickle.dumps(self.image_list))
+        print("--> imported trace snapshot: {} images, {} layers.".format(ix.num_image, ix.num_layer))
 
     @time_func
     def load_from_db(self, apply_filter=True, *,
@@ -177,6 +495,41 @@ class Tracer(ECRImageDB, metaclass=Singleton):
                 value = str(self.metric_map[m])
                 f.write(m + "," + value + "\n")
 
+    def set_lat_mode(self, mode="exact"):
+        if mode not in ("exact", "histogram"):
+            raise Exception("--> unknown latency mode: {}.".format(mode))
+        self.lat_mode = mode
+        self.lat_list, self.provision_lat_list = [], []
+        self.lat_hist = LatencyHistogram() if mode == "histogram" else None
+        self.provision_lat_hist = LatencyHistogram() if mode == "histogram" else None
+
+    def set_result_format(self, result_format="csv"):
+        if result_format not in ("csv", "npy"):
+            raise Exception("--> unknown result format: {}.".format(result_format))
+        self.result_format = result_format
+
+    def _dump_lats(self, base, policy, lat_list, lat_hist):
+        """ the latencies in a file per policy, a histogram as value,count rows """
+        name = base + ("_hist_" if lat_hist is not None else "_") + policy + "_" + SERIAL_NUM
+        if self.result_format == "npy":
+            if lat_hist is not None:
+                data = np.array(lat_hist.nonzero(), dtype=np.float64).reshape(-1, 2)
+            else:
+                data = np.asarray(lat_list)
+            np.save(name + ".npy", data)
+            with open(name + ".json", "w") as f:
+                json.dump({"metric_map": dict(self.metric_map),
+                           "metric_setup_map": dict(self.metric_setup_map)}, f, default=_json_value)
+            return
+
+        with open(name + ".csv", "w") as f:
+            if lat_hist is not None:
+                for l, c in lat_hist.nonzero():
+                    f.write(str(l) + "," + str(c) + "\n")
+            else:
+                for l in lat_list:
+                    f.write(str(l) + "\n")
+
     def dump_lat_result(self, policy):
         print("--> latencies in percentiles: ", self.percent_lat)
 
@@ -184,12 +537,12 @@ class Tracer(ECRImageDB, metaclass=Singleton):
             f.write(",".join([str(l)
                               for l in self.percent_lat]))
 
-        with open(LAT_RESULTS + "_" + policy + "_" + SERIAL_NUM + ".csv", "w") as f:
-            for l in self.lat_list:
-                f.write(str(l) + "\n")
+        self._dump_lats(LAT_RESULTS, policy, self.lat_list, self.lat_hist)
 
         # reset here since we keep the result states in this class object
         self.lat_list = []
+        if self.lat_hist is not None:
+            self.lat_hist = LatencyHistogram()
 
     def dump_provision_lat_result(self, policy):
         print("--> provision latencies in percentiles: ", self.percent_provision_lat)
@@ -198,26 +551,32 @@ class Tracer(ECRImageDB, metaclass=Singleton):
             f.write(",".join([str(l)
                               for l in self.percent_provision_lat]))
 
-        with open(PROVISION_LAT_RESULTS + "_" + policy + "_" + SERIAL_NUM + ".csv", "w") as f:
-            for l in self.lat_list:
-                f.write(str(l) + "\n")
+        self._dump_lats(PROVISION_LAT_RESULTS, policy, self.provision_lat_list, self.provision_lat_hist)
 
         # reset here since we keep the result states in this class object
         self.provision_lat_list = []
+        if self.provision_lat_hist is not None:
+            self.provision_lat_hist = LatencyHistogram()
+
+    @staticmethod
+    def _percentiles(lat_list, lat_hist, percentiles):
+        if lat_hist is not None:
+            loc_list = [int(p * 0.01 * len(lat_hist)) for p in percentiles]
+            return [lat_hist.value_at_rank(i) for i in loc_list]
+        lat_list = sorted(lat_list)
+        loc_list = [int(p * 0.01 * len(lat_list)) for p in percentiles]
+        return [lat_list[i] for i in loc_list]
 
     def cal_lat_percentile(self, percentiles=(5, 25, 50, 75, 95)):
         """ also attach the mean latency at the end """
-        lat_list = sorted(self.lat_list)
-        loc_list = [int(p * 0.01 * len(lat_list)) for p in percentiles]
-        self.percent_lat = [lat_list[i] for i in loc_list]
+        self.percent_lat = self._percentiles(self.lat_list, self.lat_hist, percentiles)
         self.percent_lat.append(self.metric_map["mean_lat"])
         # print(self.percent_lat)
 
     def cal_provision_lat_percentile(self, percentiles=(5, 25, 50, 75, 95)):
         """ also attach the mean latency at the end """
-        lat_list = sorted(self.provision_lat_list)
-        loc_list = [int(p * 0.01 * len(lat_list)) for p in percentiles]
-        self.percent_provision_lat = [lat_list[i] for i in loc_list]
+        self.percent_provision_lat = self._percentiles(self.provision_lat_list, self.provision_lat_hist,
+                                                       percentiles)
         self.percent_provision_lat.append(self.metric_map["mean_provision_lat"])
         print(self.percent_provision_lat)
 
@@ -236,10 +595,23 @@ class Tracer(ECRImageDB, metaclass=Singleton):
             return self.metric_setup_map[key]
 
     def add_lat_result(self, lat):
-        self.lat_list.append(lat)
+        if self.lat_hist is not None:
+            self.lat_hist.add(lat)
+        else:
+            self.lat_list.append(lat)
 
     def add_provision_lat_result(self, lat):
-        self.provision_lat_list.append(lat)
+        if self.provision_lat_hist is not None:
+            self.provision_lat_hist.add(lat)
+        else:
+            self.provision_lat_list.append(lat)
+
+    def merge_provision_lat_result(self, lats):
+        """ lats as a list or a LatencyHistogram, e.g., from a policy worker """
+        if self.provision_lat_hist is not None:
+            self.provision_lat_hist.merge(lats)
+        else:
+            self.provision_lat_list.extend(lats)
 
     def image_list_(self):
         return self.image_list
@@ -252,18 +624,41 @@ class Tracer(ECRImageDB, metaclass=Singleton):
         return random.sample(self.image_list, count)
 
     def image_size(self, image):
-        return self.imageinfo_map[image][1]
+        return self.ix.image_size(self.ix.image_id(image))
 
     def image_pop_list_(self):
         if self.image_pop_list is None:
-            self.image_pop_list = [(k, v[0])
-                                   for k, v in self.imageinfo_map.items() if k in self.image_list]
+            pops = self.ix.image_pops.tolist()
+            self.image_pop_list = [(self.ix.image_name(i), pops[i])
+                                   for i in self.ix.listed.tolist()]
         return self.image_pop_list
 
+    def image_list_ids_(self):
+        """The ids of image_list, in list order."""
+        if self.image_list_ids is None:
+            listed = self.ix.listed
+            # the listed ids are those of image_list but for duplicates
+            self.image_list_ids = listed if len(listed) == len(self.image_list) else \
+                np.array([self.ix.image_id(n) for n in self.image_list], dtype=np.int32)
+        return self.image_list_ids
+
+    def image_pop_ids_(self, zipf=False):
+        """The entries of image_pop_list_, or image_pop_list_zipf_, as an
+        array of image ids and a list of popularities, in the same order."""
+        if zipf not in self.image_pop_ids:
+            listed = self.ix.listed
+            if zipf:
+                # image_pop_list_zipf_ ranks the images by popularity, stably
+                order = np.argsort(-self.ix.image_pops[listed], kind="stable")
+                ids, pops = listed[order], [p for _, p in self.image_pop_list_zipf_()]
+            else:
+                ids, pops = listed, self.ix.image_pops[listed].tolist()
+            self.image_pop_ids[zipf] = (ids, pops)
+        return self.image_pop_ids[zipf]
+
     def image_pop_list_zipf_(self, alpha=0.75):
         if self.image_pop_list_zipf is None:
-            self.image_pop_list_zipf = [(name, entry[0]) for name, entry in
-                                        self.imageinfo_map.items() if name in self.image_list]
+            self.image_pop_list_zipf = list(self.image_pop_list_())
             # replace the popularity with zipf samples
             num_images = len(self.image_pop_list_zipf)
 
@@ -281,33 +676,32 @@ class Tracer(ECRImageDB, metaclass=Singleton):
         return self.image_pop_list_zipf
 
 
+    # the lookups by name below are thin wrappers of the interned index;
+    # the simulation works on the ids directly
     def layers_(self, image):
-        layers = self.imageinfo_map[image][2]
-        # assert len(layers) > 0
-        return layers
+        ix = self.ix
+        return {ix.layer_digest(l) for l in ix.image_layers(ix.image_id(image))}
 
     def layer_size(self, digest):
-        # assert digest in self.layerinfo_map
-        return self.layerinfo_map[digest][1]
+        return self.ix.layer_size(self.ix.layer_id(digest))
 
     def layer_image(self, digest):
-        return self.layerinfo_map[digest][2]
+        ix = self.ix
+        return {ix.image_name(i) for i in ix.layer_images(ix.layer_id(digest)).tolist()}
 
     def layer_pop_list_(self):
         if self.layer_pop_list is None:
-            self.layer_pop_list = [(k, v[0])
-                                   for k, v in self.layerinfo_map.iteritems()]
+            self.layer_pop_list = [(self.ix.layer_digest(l), pop)
+                                   for l, pop in enumerate(self.ix.layer_pops.tolist())]
         return self.layer_pop_list
 
     def layer_pull_time(self, digest):
         # a few config layers having zero size are not recorded in the trace
         # TODO: add on the fly layer pull generation based on some equation derived
         # TODO: from the layer pulling results
-        assert digest in self.layerinfo_map
-        # if digest not in self.layerpull_map:
+        # if digest not in the pull trace:
         # return self.layer_pull_time_from_size(self.layer_size(digest))
-        dl_time, reg_time = self.layerpull_map[digest]
-        return dl_time + reg_time
+        return self.ix.layer_pull_time(self.ix.layer_id(digest))
 
     def layer_pull_time_from_size(self, layer_size, from_instance="m4.xlarge"):
         """Derive the reg and download latencies derived from the trace.
@@ -325,9 +719,10 @@ class Tracer(ECRImageDB, metaclass=Singleton):
         """Analyze the layer pull time results."""
         bin_flat, bin_linear = [], []
         sep_value = 10 ** 5
-        for digest in self.layerpull_map:
-            dl_time, reg_time = self.layerpull_map[digest]
-            layer_size = self.layer_size(digest)
+        ix = self.ix
+        for l in range(ix.num_layer):
+            dl_time, reg_time = ix.layer_dl_time(l), ix.layer_reg_time(l)
+            layer_size = ix.layer_size(l)
             entry = (layer_size, dl_time, reg_time, dl_time + reg_time)
             if layer_size <= sep_value:
                 bin_flat.append(entry)
@@ -342,14 +737,10 @@ class Tracer(ECRImageDB, metaclass=Singleton):
         print(mean_flat_dl, mean_flat_reg, mean_flat_total, z)
 
     def layer_dl_time(self, digest):
-        if digest not in self.layerpull_map:
-            return 0
-        return self.layerpull_map[digest][0]
+        return self.ix.layer_dl_time(self.ix.layer_id(digest))
 
     def layer_reg_time(self, digest):
-        if digest not in self.layerpull_map:
-            return 0
-        return self.layerpull_map[digest][1]
+        return self.ix.layer_reg_time(self.ix.layer_id(digest))
 
     def filter_image(self, image_entry, filter):
         """Return true if any filter condition is met."""
@@ -360,15 +751,13 @@ class Tracer(ECRImageDB, metaclass=Singleton):
         return False
 
     def stats_summary(self):
-        assert len(self.layerinfo_map) == len(self.layerpull_map)
-        image_items = self.imageinfo_map.items()
-        layer_items = self.layerinfo_map.items()
-        total_image_count = len(image_items)
-        total_image_size = sum([i[1][1] for i in image_items])
-        max_image_size = max([i[1][1] for i in image_items])
-        total_layer_count = len(layer_items)
-        total_layer_size = sum([l[1][1] for l in layer_items])
-        max_layer_size = max([l[1][1] for l in layer_items])
+        ix = self.ix
+        total_image_count = ix.num_image
+        total_image_size = int(ix.image_sizes.sum())
+        max_image_size = int(ix.image_sizes.max())
+        total_layer_count = ix.num_layer
+        total_layer_size = int(ix.layer_sizes.sum())
+        max_layer_size = int(ix.layer_sizes.max())
 
         print("--> total image count: " + str(total_image_count))
         print("--> total image size: {} gb".format(int(total_image_size / gb)))
@@ -379,14 +768,8 @@ class Tracer(ECRImageDB, metaclass=Singleton):
         print("--> max layer size: {} mb".format(int(max_layer_size / mb)))
         print("--> avg. layer size: {} mb".format(int(total_layer_size / total_layer_count / mb)))
 
-        layer_set, size = set(), 0
-
-        for image in image_items:
-            layers = image[1][2]
-            for l in layers:
-                if l not in layer_set:
-                    layer_set.add(l)
-                    size += self.layer_size(l)
+        # every layer is referenced by some image
+        size = int(ix.layer_sizes[np.unique(ix.image_layer_idx)].sum())
         # print(size, total_layer_size)
         assert size == total_layer_size
         print("--> stats checks pass")
@@ -394,7 +777,7 @@ class Tracer(ECRImageDB, metaclass=Singleton):
         # print([(image[0], image[1][0]) for image in self.top_popular_images()])
 
     def dump_cdf(self):
-        dots = sorted([(key, entry[1]) for key, entry in self.imageinfo_map.items()], key=lambda x: x[1])
+        dots = sorted(enumerate(self.ix.image_sizes.tolist()), key=lambda x: x[1])
         cdf = []
         for i, dot in enumerate(dots):
             cdf.append([str(dot[1]), str(i / len(dots))])
@@ -403,8 +786,7 @@ class Tracer(ECRImageDB, metaclass=Singleton):
                 f.write(",".join(line) + "\n")
 
     def get_total_image_size(self):
-        image_items = self.imageinfo_map.items()
-        return sum([i[1][1] for i in image_items])
+        return sum(self.ix.image_sizes.tolist())
 
     def analyze_req_list(self, req_list):
         histogram = defaultdict(int)
@@ -414,7 +796,10 @@ class Tracer(ECRImageDB, metaclass=Singleton):
         print(sorted(list(histogram.items()), key=lambda x: x[1], reverse=True)[:10])
 
     def top_popular_images(self, rank=100):
-        return sorted(list(self.imageinfo_map.items()), key=lambda x: x[1][0], reverse=True)[:rank]
+        ix = self.ix
+        pops, sizes = ix.image_pops.tolist(), ix.image_sizes.tolist()
+        ranked = sorted(range(ix.num_image), key=lambda i: pops[i], reverse=True)[:rank]
+        return [(ix.image_name(i), [pops[i], sizes[i], self.layers_(ix.image_name(i))]) for i in ranked]
 
 
 def main():
@@ -423,6 +808,8 @@ def main():
     cmds = {
         "dump_redis": tracer.dump_to_redis,
         "load_redis": tracer.load_from_redis,
+        "export_snapshot": tracer.export_snapshot,
+        "import_snapshot": tracer.import_snapshot,
         "stat": tracer.stats_summary,
         "cdf": tracer.dump_cdf,
         "zipf": tracer.image_pop_list_zipf_,
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+
+import array
+import datetime
+import hashlib
+import json
+import os
+import random
+from collections import Counter
+
+import numpy as np
+
+from .utils import dir_check
+
+"""
+Workloads as compact arrays, and their on-disk cache
+
+a workload is the per-tick arrival counts (req_seq), the image ids of each
+request in CSR form (image_ptr, image_ids), the durations, and the global
+rng states the generation left behind, such that a cache hit leaves the
+random and np.random streams as a fresh generation would
+
+generate draws a workload in batched np.random calls, instead of the
+per-request loop of Simulator.init_req_queue; RequestStream draws the
+requests one at a time on access, without ever holding the workload;
+ReplayStream replays the requests of a jsonl log the same way
+
+the cache is content-addressed: the key hashes the generation parameters,
+the trace digest and the rng states the generation starts from; an entry is
+a directory of .npy files, memory-mapped on load
+"""
+
+_dir_path = os.path.dirname(os.path.realpath(__file__))
+WORKLOAD_CACHE = os.environ.get("WORKLOAD_CACHE", _dir_path + "/__workload__/")
+# bump on any change of the generation or the layout; old entries then miss
+WORKLOAD_VERSION = 2
+
+
+def rng_state():
+    """The random and np.random states as arrays."""
+    version, py_keys, py_gauss = random.getstate()
+    _, np_keys, np_pos, np_has_gauss, np_gauss = np.random.get_state()
+    return {
+        "py_keys": np.array(py_keys, dtype=np.uint32),
+        "py_gauss": np.array([np.nan if py_gauss is None else py_gauss]),
+        "np_keys": np.asarray(np_keys, dtype=np.uint32),
+        "np_misc": np.array([np_pos, np_has_gauss, np_gauss], dtype=np.float64),
+    }
+
+
+def set_rng_state(state):
+    py_gauss = float(state["py_gauss"][0])
+    random.setstate((3, tuple(state["py_keys"].tolist()), None if np.isnan(py_gauss) else py_gauss))
+    np_pos, np_has_gauss, np_gauss = state["np_misc"].tolist()
+    np.random.set_state(("MT19937", np.array(state["np_keys"]), int(np_pos), int(np_has_gauss), np_gauss))
+
+
+def to_arrays(req_seq, req_list):
+    """The arrays of a workload; req_list as [([int_image_id, ...], int_duration)...]."""
+    ptr = np.zeros(len(req_list) + 1, dtype=np.int64)
+    np.cumsum([len(images) for images, _ in req_list], out=ptr[1:])
+    return {
+        "req_seq": np.array(req_seq, dtype=np.int64),
+        "image_ptr": ptr,
+        "image_ids": np.array([i for images, _ in req_list for i in images], dtype=np.int32),
+        "durations": np.array([d for _, d in req_list], dtype=np.int64),
+    }
+
+
+class Requests:
+    """A list-like view of the workload arrays: requests[i] is
+    [[int_image_id, ...], int_duration], built on access instead of
+    holding a list per request. The arrays, e.g., memory-mapped from the
+    cache, are indexed as is; the durations are copied on the first write."""
+    __slots__ = ("ptr", "ids", "durations")
+
+    def __init__(self, arrays):
+        self.ptr = arrays["image_ptr"]
+        self.ids = arrays["image_ids"]
+        self.durations = arrays["durations"]
+
+    def __len__(self):
+        return len(self.durations)
+
+    def __getitem__(self, i):
+        return [self.ids[self.ptr[i]:self.ptr[i + 1]].tolist(), int(self.durations[i])]
+
+    def __setitem__(self, i, req):
+        # only the duration of a request may change
+        images, duration = req
+        assert list(images) == self[i][0], "--> request images changed."
+        if not self.durations.flags.writeable:
+            self.durations = np.array(self.durations)
+        self.durations[i] = duration
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+def to_req_list(arrays):
+    return Requests(arrays)
+
+
+def _distinct_rows(num_pool, sizes):
+    """Rows of distinct picks from range(num_pool), each row sizes[i] long,
+    padded with -1; rows with repeats are redrawn until none has any."""
+    width = int(sizes.max()) if len(sizes) else 0
+    assert width <= num_pool, "--> sampling {} out of {}.".format(width, num_pool)
+    padding = np.arange(width) >= sizes[:, None]
+    rows = np.random.randint(num_pool, size=(len(sizes), width))
+    todo = np.arange(len(sizes))
+    while len(todo):
+        # the padding columns get distinct negative values, never repeats
+        r = np.where(padding[todo], -1 - np.arange(width), rows[todo])
+        r.sort(axis=1)
+        todo = todo[(r[:, 1:] == r[:, :-1]).any(axis=1)]
+        rows[todo] = np.random.randint(num_pool, size=(len(todo), width))
+    rows[padding] = -1
+    return rows
+
+
+def alias_table(weights):
+    """Walker's alias table (Vose's construction) of the weights: pick a
+    column uniformly, keep it with its probability, else take its alias."""
+    n = len(weights)
+    scaled = (np.asarray(weights, dtype=np.float64) * (n / np.sum(weights))).tolist()
+    prob, alias = [1.0] * n, list(range(n))
+    small = [i for i, p in enumerate(scaled) if p < 1]
+    large = [i for i, p in enumerate(scaled) if p >= 1]
+    while small and large:
+        s, l = small.pop(), large[-1]
+        prob[s], alias[s] = scaled[s], l
+        scaled[l] -= 1 - scaled[s]
+        if scaled[l] < 1:
+            small.append(large.pop())
+    return np.array(prob), np.array(alias, dtype=np.int64)
+
+
+def generate(tracer, sim_length, req_rate, uniform, zipf, cont_length, max_num_image):
+    """A workload of the same distribution as Simulator.init_req_queue
+    draws, in batched np.random calls: Poisson arrivals per tick, a set size
+    uniform in [1, max_num_image], the images drawn uniformly (distinct
+    positions of the image list) or by popularity (an alias table, with
+    replacement), the durations uniform in
+    [1, cont_length]."""
+    num_req = sim_length * req_rate
+
+    req_seq = np.empty(0, dtype=np.int64)
+    while req_seq.sum() < num_req:
+        req_seq = np.concatenate([req_seq, np.random.poisson(req_rate, size=max(sim_length, 1))])
+    req_seq = req_seq[:int(np.searchsorted(np.cumsum(req_seq), num_req)) + 1]
+    num_req = int(req_seq.sum())
+
+    sizes = np.random.randint(1, max_num_image + 1, size=num_req)
+    ptr = np.zeros(num_req + 1, dtype=np.int64)
+    np.cumsum(sizes, out=ptr[1:])
+    if uniform and not zipf:
+        list_ids = tracer.image_list_ids_()
+        rows = _distinct_rows(len(list_ids), sizes)
+        image_ids = list_ids[rows[rows >= 0]]
+    else:
+        pop_ids, weights = tracer.image_pop_ids_(zipf)
+        prob, alias = alias_table(weights)
+        picks = np.random.randint(len(pop_ids), size=int(ptr[-1]))
+        picks = np.where(np.random.random(len(picks)) < prob[picks], picks, alias[picks])
+        image_ids = pop_ids[picks]
+    durations = (np.random.random(num_req) * cont_length + 1).astype(np.int64)
+
+    return {
+        "req_seq": req_seq.astype(np.int64),
+        "image_ptr": ptr,
+        "image_ids": image_ids.astype(np.int32),
+        "durations": durations,
+    }
+
+
+class LazyRequests:
+    """A list-like of requests made on access by _make(i); only the last
+    cache_size made are kept, and rewinding drops them. Subclasses set
+    num_req and req_seq, the per-tick arrival counts."""
+
+    def __init__(self, cache_size=1 << 16):
+        self.cache_size = cache_size
+        self.cache = {}
+
+    def __len__(self):
+        return self.num_req
+
+    def __getitem__(self, i):
+        req = self.cache.get(i)
+        if req is not None:
+            return req
+        assert 0 <= i < self.num_req, "--> request index out of range: {}.".format(i)
+        req = self._make(i)
+        if len(self.cache) >= self.cache_size:
+            # the first made goes first, dicts keep the insertion order
+            del self.cache[next(iter(self.cache))]
+        self.cache[i] = req
+        return req
+
+    def __iter__(self):
+        return (self[i] for i in range(self.num_req))
+
+    def rewind(self):
+        """Restart the requests, e.g., for the next policy; the requests
+        made again are the same."""
+        self.cache = {}
+
+
+class RequestStream(LazyRequests):
+    """A workload generated on access, never materialized.
+
+    Request i is drawn from its own Philox stream keyed by the seed, with i
+    in a high counter word as the counter advances from its low word, so any
+    request can be (re)generated alone, in any order.
+    The distributions are those of generate."""
+    _counts_stream, _req_stream = 0, 1
+
+    def __init__(self, tracer, sim_length, req_rate, uniform, zipf, cont_length, max_num_image,
+                 seed, cache_size=1 << 16):
+        super().__init__(cache_size)
+        self.seed = seed
+        self.cont_length = cont_length
+        self.max_num_image = max_num_image
+        self.uniform = uniform and not zipf
+
+        if self.uniform:
+            self.pool = tracer.image_list_ids_()
+            assert max_num_image <= len(self.pool), "--> sampling {} out of {}.".format(
+                max_num_image, len(self.pool))
+        else:
+            self.pool, weights = tracer.image_pop_ids_(zipf)
+            self.prob, self.alias = alias_table(weights)
+            self._prob, self._alias = self.prob.tolist(), self.alias.tolist()
+        self._pool = self.pool.tolist()
+
+        num_req = sim_length * req_rate
+        rng = self._rng(self._counts_stream, 0)
+        req_seq = np.empty(0, dtype=np.int64)
+        while req_seq.sum() < num_req:
+            req_seq = np.concatenate([req_seq, rng.poisson(req_rate, size=max(sim_length, 1))])
+        req_seq = req_seq[:int(np.searchsorted(np.cumsum(req_seq), num_req)) + 1]
+        self.req_seq = req_seq.tolist()
+        self.num_req = int(req_seq.sum())
+
+    def _rng(self, stream, counter):
+        return np.random.Generator(np.random.Philox(key=[self.seed, stream], counter=[0, 0, counter, 0]))
+
+    def _make(self, i):
+        rng = self._rng(self._req_stream, i)
+        num_image = int(rng.integers(1, self.max_num_image + 1))
+        if self.uniform:
+            images = [self._pool[j] for j in rng.choice(len(self._pool), num_image, replace=False).tolist()]
+        else:
+            columns, coins = rng.integers(len(self._pool), size=num_image).tolist(), rng.random(num_image).tolist()
+            images = [self._pool[c if coin < self._prob[c] else self._alias[c]]
+                      for c, coin in zip(columns, coins)]
+        return [images, int(rng.random() * self.cont_length + 1)]
+
+
+def _replay_time(value):
+    # seconds, or an iso 8601 date
+    if isinstance(value, str):
+        return datetime.datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    return float(value)
+
+
+class ReplayStream(LazyRequests):
+    """Requests replayed from a jsonl log, a record per line:
+        {"timestamp": <seconds or iso 8601>, "image": <name> or "images": [<name>, ...],
+         "duration": <seconds>}
+
+    One pass over the file buckets the records into ticks of tick_len
+    seconds from the first timestamp and keeps only each record's byte
+    offset and length; a request is read from the file again when accessed. Image
+    names are mapped onto the tracer ids; the names not in the trace are
+    dropped from their requests and counted in unmatched, and a request
+    left with no image is skipped."""
+
+    def __init__(self, tracer, path, tick_len=1.0, cache_size=1 << 16):
+        super().__init__(cache_size)
+        self.path = path
+        self.tick_len = tick_len
+        self.ix = tracer.ix
+        self.unmatched = Counter()
+        self.num_record = 0
+        self.num_unmatched_req = 0
+
+        offsets, lengths, times = array.array("q"), array.array("q"), array.array("d")
+        with open(path, "rb") as f:
+            offset = 0
+            for line in f:
+                if line.strip():
+                    self.num_record += 1
+                    record = json.loads(line)
+                    if self._images(record, count=True):
+                        offsets.append(offset)
+                        lengths.append(len(line))
+                        times.append(_replay_time(record["timestamp"]))
+                    else:
+                        self.num_unmatched_req += 1
+                offset += len(line)
+
+        times = np.array(times, dtype=np.float64)
+        ticks = ((times - times.min()) // tick_len if len(times) else times).astype(np.int64)
+        # the requests in tick order, the log order within a tick
+        order = np.argsort(ticks, kind="stable")
+        self.offsets = np.array(offsets, dtype=np.int64)[order]
+        self.lengths = np.array(lengths, dtype=np.int64)[order]
+        self.req_seq = np.bincount(ticks).tolist()
+        self.num_req = len(self.offsets)
+        # positional reads, the forked policy workers share no file offset
+        self.fd = os.open(path, os.O_RDONLY)
+
+    def _images(self, record, count=False):
+        names = record["images"] if "images" in record else [record["image"]]
+        images = []
+        for name in names:
+            try:
+                images.append(self.ix.image_id(name))
+            except KeyError:
+                if count:
+                    self.unmatched[name] += 1
+        return images
+
+    def _make(self, i):
+        record = json.loads(os.pread(self.fd, int(self.lengths[i]), int(self.offsets[i])))
+        duration = max(1, int(round(float(record["duration"]) / self.tick_len)))
+        return [self._images(record), duration]
+
+    def report(self, top=10):
+        print("--> replayed {} of {} records from {} in {} ticks.".format(
+            self.num_req, self.num_record, self.path, len(self.req_seq)))
+        if self.unmatched:
+            print("--> {} unmatched images ({} references), {} requests left without any; top: {}".format(
+                len(self.unmatched), sum(self.unmatched.values()), self.num_unmatched_req,
+                self.unmatched.most_common(top)))
+
+
+class WorkloadCache:
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or WORKLOAD_CACHE
+
+    def key(self, params, trace_digest, state):
+        h = hashlib.sha1(json.dumps({"version": WORKLOAD_VERSION,
+                                     "params": params,
+                                     "trace": trace_digest}, sort_keys=True).encode())
+        for name in sorted(state):
+            h.update(state[name].tobytes())
+        return h.hexdigest()
+
+    def load(self, key):
+        """The arrays of an entry, memory-mapped; None on a miss."""
+        path = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(path):
+            return None
+        return {f[:-len(".npy")]: np.load(os.path.join(path, f), mmap_mode="r")
+                for f in os.listdir(path) if f.endswith(".npy")}
+
+    def store(self, key, arrays):
+        path = os.path.join(self.cache_dir, key)
+        tmp = path + ".{}.tmp".format(os.getpid())
+        dir_check(tmp)
+        for name, a in arrays.items():
+            np.save(os.path.join(tmp, name + ".npy"), a)
+        try:
+            # a concurrent writer of the same key wrote the same arrays
+            os.rename(tmp, path)
+        except OSError:
+            for f in os.listdir(tmp):
+                os.remove(os.path.join(tmp, f))
+            os.rmdir(tmp)